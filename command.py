@@ -3,7 +3,8 @@
 from datetime import timedelta, datetime
 import os, sys
 from optparse import (OptionParser, OptionGroup)
-import shlex, subprocess
+import shlex, subprocess, selectors, threading, uuid, time
+from concurrent.futures import ThreadPoolExecutor
 
 # Contains the result of a command run using run_command().
 class CommandResult:
@@ -42,7 +43,7 @@ def execute(command_line, directory = None, \
         print_timing_info = False, shell='/bin/bash', \
         grab_output = True, ignore_exit_code = False, \
         input_string = None, auto_decode=True,
-        decode_using=sys.stdout.encoding):
+        decode_using=sys.stdout.encoding, pool = None):
     """Run an operating system command. This is an updated
     version of run_command() which returns a CommandResult
     object instead of a tuple.
@@ -69,7 +70,19 @@ def execute(command_line, directory = None, \
     decode_using: the encoding used to decode stdout/stderr. Only
         has an effect if auto_decode is set to True. Defaults to
         sys.stdout.encoding.
+    pool: if not None, a CommandPool to run the command on instead
+        of spawning a new shell. The command's shell is then the
+        pool's shell; grab_output must be True and input_string
+        is not supported.
     """
+    if pool != None:
+        if not grab_output or input_string != None:
+            raise ValueError('pooled commands must grab output and cannot take input')
+
+        return pool.execute(command_line, directory=directory,
+                ignore_exit_code=ignore_exit_code, auto_decode=auto_decode,
+                decode_using=decode_using)
+
     # For stuff we run through the shell shlex splitting doesn't work,
     # so we just pass command_line straight through to bash.
     #args = shlex.split(command_line)
@@ -138,3 +151,237 @@ def _run_no_output(command_line, shell, directory):
 	p.wait()
 
 	return p
+
+class _PooledShell:
+    """A long-lived shell process that runs commands fed to it over
+    its stdin. Each command is run in a subshell (so cd/export/etc.
+    don't leak into the next command) and is followed by a marker
+    token on stdout (carrying the exit code) and on stderr, which is
+    how we know where one command's output ends."""
+    def __init__(self, shell):
+        self.process = subprocess.Popen([shell], env=os.environ,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def run(self, command_line, directory):
+        token = ('__jpy_pool_' + uuid.uuid4().hex + '__').encode('ascii')
+
+        script = '( cd -- ' + shlex.quote(directory) + ' && eval ' + \
+                shlex.quote(command_line) + ' ) </dev/null\n' + \
+                "printf '%s %d\\n' " + token.decode('ascii') + ' "$?"\n' + \
+                "printf '%s' " + token.decode('ascii') + ' >&2\n'
+
+        self.process.stdin.write(script.encode())
+        self.process.stdin.flush()
+
+        out_fd = self.process.stdout.fileno()
+        err_fd = self.process.stderr.fileno()
+        buffers = {out_fd: bytearray(), err_fd: bytearray()}
+        # where the token was found in each buffer, and where each
+        # stream's output ended (once all of its marker has been read)
+        token_found = {}
+        token_at = {}
+
+        with selectors.DefaultSelector() as sel:
+            sel.register(out_fd, selectors.EVENT_READ)
+            sel.register(err_fd, selectors.EVENT_READ)
+
+            while len(token_at) < 2:
+                for key, _ in sel.select():
+                    fd = key.fd
+                    buf = buffers[fd]
+                    scan_from = max(0, len(buf) - len(token))
+
+                    data = os.read(fd, 65536)
+                    if not data:
+                        raise OSError('pooled shell ' + str(self.process.pid) + \
+                                ' exited while running "' + str(command_line) + '"')
+                    buf += data
+
+                    if fd not in token_found:
+                        i = buf.find(token, scan_from)
+                        if i < 0: continue
+                        token_found[fd] = i
+
+                    # stdout is finished once the exit code after the token
+                    # has been read in full (the read may have stopped part
+                    # way through it); stderr once the token arrives
+                    i = token_found[fd]
+                    if fd == err_fd or buf.find(b'\n', i + len(token)) >= 0:
+                        token_at[fd] = i
+                        sel.unregister(fd)
+
+        stdout = buffers[out_fd]
+        exit_code = int(stdout[token_at[out_fd] + len(token):])
+        return bytes(stdout[:token_at[out_fd]]), \
+                bytes(buffers[err_fd][:token_at[err_fd]]), exit_code
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+class CommandPool:
+    """A pool of long-lived shell processes, used to avoid paying
+    for a fork/exec of a new shell for every command when running
+    lots of small ones. Commands are handed to an idle shell over a
+    pipe and the output and exit code are read back, giving the
+    same CommandResult as execute() (though result.process is None,
+    as there is no process dedicated to the command).
+
+    Every command runs in a fresh subshell in the given directory
+    (or this script's current directory), so changes a command makes
+    to its working directory or environment are gone by the time the
+    next command runs. Shells take a copy of os.environ when they are
+    started; later changes to os.environ are not seen by the pool.
+
+    The pool can be used by several threads at once; at most size
+    commands run concurrently, and callers wait for a free shell
+    beyond that. Use close() (or a with block) to stop the shells.
+
+    init parameters:
+        size: maximum number of shell processes to keep
+        shell: the shell to run commands with (must not be None)
+    """
+    def __init__(self, size = 4, shell = '/bin/bash'):
+        if shell == None: raise ValueError('CommandPool needs a shell to run commands with')
+        if size < 1: raise ValueError('size must be at least 1: ' + str(size))
+
+        self.size = size
+        self.shell = shell
+
+        # idle shells (most recently used last) and all live shells;
+        # _available is notified whenever a shell becomes idle or a
+        # place for a new one is freed up
+        self._available = threading.Condition()
+        self._idle = []
+        self._shells = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _acquire(self):
+        with self._available:
+            while True:
+                if self._closed: raise ValueError('CommandPool has been closed')
+
+                if self._idle:
+                    return self._idle.pop()
+
+                if len(self._shells) < self.size:
+                    shell = _PooledShell(self.shell)
+                    self._shells.append(shell)
+                    return shell
+
+                self._available.wait()
+
+    def _release(self, shell):
+        with self._available:
+            if not self._closed:
+                self._idle.append(shell)
+                self._available.notify()
+                return
+            # the pool was closed while the command ran, and left this
+            # shell for us to stop
+            self._shells.remove(shell)
+        shell.close()
+
+    def _discard(self, shell):
+        with self._available:
+            if shell in self._shells:
+                self._shells.remove(shell)
+                self._available.notify()
+        shell.process.kill()
+        shell.close()
+
+    def execute(self, command_line, directory = None, ignore_exit_code = False,
+            auto_decode = True, decode_using = sys.stdout.encoding):
+        """Run command_line on one of the pool's shells, returning a
+        CommandResult. Parameters behave as for execute()."""
+        if directory == None: directory = os.getcwd()
+
+        shell = self._acquire()
+        before = datetime.now()
+
+        try:
+            stdout, stderr, exit_code = shell.run(command_line, directory)
+        except BaseException:
+            # the shell may be part-way through the command, so it can't
+            # be reused; the pool will start another one when needed
+            self._discard(shell)
+            raise
+
+        after = datetime.now()
+        self._release(shell)
+
+        if not ignore_exit_code and exit_code != 0:
+            raise OSError('Command "' + str(command_line) + \
+                    '" failed with exit code: ' + str(exit_code))
+
+        if auto_decode:
+            if stdout: stdout=stdout.decode(decode_using)
+            if stderr: stderr=stderr.decode(decode_using)
+
+        return CommandResult(
+                process=None,
+                stdout=stdout,
+                stderr=stderr,
+                start_time=before,
+                finish_time=after,
+                exit_code=exit_code)
+
+    def execute_many(self, command_lines, **kwargs):
+        """Run each of command_lines across the pool's shells, returning
+        a list of CommandResults in the same order. kwargs are passed
+        to execute()."""
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = [executor.submit(self.execute, c, **kwargs) for c in command_lines]
+            return [f.result() for f in futures]
+
+    def close(self):
+        """Stop all of the pool's shells. Shells still running a command
+        (in another thread) are stopped once the command finishes."""
+        with self._available:
+            self._closed = True
+            shells, self._idle = self._idle, []
+            for shell in shells:
+                self._shells.remove(shell)
+            self._available.notify_all()
+
+        for shell in shells:
+            shell.close()
+
+def _benchmark(count = 1000, size = 4):
+    """Compare running count trivial commands with execute() against
+    running them through a CommandPool."""
+    start = time.perf_counter()
+    for i in range(count):
+        execute('true')
+    spawned = time.perf_counter() - start
+
+    with CommandPool(size=1) as pool:
+        start = time.perf_counter()
+        for i in range(count):
+            pool.execute('true')
+        pooled = time.perf_counter() - start
+
+    with CommandPool(size=size) as pool:
+        start = time.perf_counter()
+        pool.execute_many(['true'] * count)
+        pooled_many = time.perf_counter() - start
+
+    print('execute():                  %8.1f commands/sec' % (count / spawned))
+    print('CommandPool.execute():      %8.1f commands/sec' % (count / pooled))
+    print('CommandPool.execute_many(): %8.1f commands/sec (%d shells)' % (count / pooled_many, size))
+
+if __name__ == '__main__':
+    _benchmark()
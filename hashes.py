@@ -3,28 +3,451 @@
 
 # coding: utf-8
 
-import hashlib
+import hashlib, itertools, mmap, os, sqlite3, tempfile, time, zlib
+from concurrent import futures
 
+def _new_hasher(algo):
+	# algo is either the name of a hashlib algorithm or a function
+	# returning a new hasher (e.g. hashlib.md5)
+	if callable(algo): return algo()
+	return hashlib.new(algo)
+
+# hashes s (a str, which is encoded as UTF-8, or bytes) with hasher
 def hash_string(s, hasher):
+	if type(s) is str: s = s.encode('utf-8')
 	hasher.update(s)
 	return hasher.hexdigest()
 
-def hash_file(filename, hasher, blocksize=65536):
-	with open(filename, 'rb') as f:
-		buf = f.read(blocksize)
-		while len(buf) > 0:
-			hasher.update(buf)
-			buf = f.read(blocksize)
+# Hashes each of strings (strs, encoded with encoding, or bytes), yielding
+# a digest for each. Meant for hashing lots of short keys (e.g. to pick a
+# shard), where setting up a new hasher for every key costs as much as
+# hashing it: one hasher is set up and copied for each key instead.
+#
+# algo is the name of a hashlib algorithm or a function returning a new
+# hasher. digest_size sets the size of the digest for blake2b and blake2s
+# (it's ignored for other algorithms); the default of blake2b with an 8-byte
+# digest is much quicker than md5 or sha256 and plenty for sharding.
+# algo can also be 'crc32' (from zlib), which is quicker still but not
+# a cryptographic hash at all.
+#
+# Digests are hex strings, or ints if as_int is True:
+#
+#   shards = [h % 16 for h in hash_strings(keys, as_int=True)]
+def hash_strings(strings, algo='blake2b', digest_size=8, as_int=False, encoding='utf-8'):
+	if algo == 'crc32':
+		for s in strings:
+			crc = zlib.crc32(s.encode(encoding) if type(s) is str else s)
+			yield crc if as_int else '%08x' % crc
+		return
+
+	if digest_size and algo in ('blake2b', 'blake2s'):
+		prototype = hashlib.new(algo, digest_size=digest_size)
+	else:
+		prototype = _new_hasher(algo)
+	copy = prototype.copy
+
+	for s in strings:
+		hasher = copy()
+		hasher.update(s.encode(encoding) if type(s) is str else s)
+		yield int.from_bytes(hasher.digest(), 'big') if as_int else hasher.hexdigest()
+
+# block sizes picked by _block_size() are at least this big
+_MIN_BLOCK_SIZE = 256*1024
+
+def _block_size(f):
+	# picks a block size for reading f: a multiple of the filesystem's
+	# preferred I/O size (st_blksize), of at least _MIN_BLOCK_SIZE
+	blksize = getattr(os.fstat(f.fileno()), 'st_blksize', 0) or 4096
+	return blksize * max(1, _MIN_BLOCK_SIZE // blksize)
+
+def _read_blocks(f, blocksize):
+	# Yields the contents of f in blocks of up to blocksize bytes. Every
+	# block is read into the same buffer, so each one is only valid until
+	# the next is read. f should be unbuffered, so data is read straight
+	# into our buffer.
+	buf = bytearray(blocksize)
+	view = memoryview(buf)
+
+	n = f.readinto(buf)
+	while n:
+		yield view if n == blocksize else view[:n]
+		n = f.readinto(buf)
+
+def _file_blocks(f, blocksize, use_mmap):
+	# yields f's contents: either as blocks read by _read_blocks(), or
+	# (with use_mmap) as a single mmap of the whole file
+	if not use_mmap:
+		yield from _read_blocks(f, blocksize or _block_size(f))
+
+	# empty files can't be mapped (and have nothing to hash)
+	elif os.fstat(f.fileno()).st_size > 0:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+			yield m
+
+# Hashes the contents of filename with hasher, returning the hexdigest.
+#
+# The file is read in blocks of blocksize bytes (picked to suit the
+# filesystem if None) into a single reused buffer. If use_mmap is True
+# the file is memory-mapped and hashed in one go instead, which avoids
+# copying its data at all; this suits large files best.
+def hash_file(filename, hasher, blocksize=None, use_mmap=False):
+	with open(filename, 'rb', buffering=0) as f:
+		for block in _file_blocks(f, blocksize, use_mmap):
+			hasher.update(block)
+
 		return hasher.hexdigest()
 
+# Hashes each chunk of bytes in chunks with each of algos (names of
+# hashlib algorithms, or functions returning a new hasher) in a single
+# pass, so chunks can be a generator. Returns a dict mapping each algo
+# (or for functions, the hasher's name) to its hexdigest, e.g.:
+#
+#   hash_chunks(response.iter_content(), ['md5', 'sha256'])
+#   # {'md5': '...', 'sha256': '...'}
+def hash_chunks(chunks, algos):
+	hashers = {}
+	for algo in algos:
+		hasher = _new_hasher(algo)
+		hashers[algo if type(algo) is str else hasher.name] = hasher
+
+	updates = [h.update for h in hashers.values()]
+	for chunk in chunks:
+		for update in updates:
+			update(chunk)
+
+	return dict((name, h.hexdigest()) for name, h in hashers.items())
+
+# As hash_chunks(), for the contents of filename, so a file can be hashed
+# with several algorithms while only being read once:
+#
+#   hash_file_multi('/path/to/file', ['md5', 'sha256', 'blake2b'])
+#
+# blocksize and use_mmap are as for hash_file().
+def hash_file_multi(filename, algos, blocksize=None, use_mmap=False):
+	with open(filename, 'rb', buffering=0) as f:
+		return hash_chunks(_file_blocks(f, blocksize, use_mmap), algos)
+
+# Hashes each of paths using a pool of workers threads, yielding
+# (path, hexdigest) pairs as each file is finished (so not necessarily
+# in the order of paths). algo is the name of a hashlib algorithm
+# (e.g. 'sha256') or a function returning a new hasher.
+#
+# hashlib releases the GIL while hashing large blocks, so threads can
+# read and hash several files at once. Only a few files per worker are
+# queued at a time, so paths can be a generator over millions of files.
+#
+# A file which can't be read (it's gone, or permission is denied) doesn't
+# stop the others being hashed. If errors is given it is called as
+# errors(path, exception) for each such file, and nothing is yielded for
+# it; otherwise (path, None) is yielded.
+def hash_files(paths, algo, workers=4, blocksize=None, errors=None):
+	paths = iter(paths)
+
+	with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		pending = {}
+
+		def submit(count):
+			for path in itertools.islice(paths, count):
+				pending[executor.submit(hash_file, path, _new_hasher(algo), blocksize)] = path
+
+		submit(workers * 2)
+
+		while pending:
+			done, not_done = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+			submit(len(done))
+
+			for f in done:
+				path = pending.pop(f)
+				try:
+					digest = f.result()
+				except OSError as e:
+					if errors != None:
+						errors(path, e)
+						continue
+					digest = None
+
+				yield path, digest
+
+# The result of hash_file_chunks(): the digest of each chunk_size-byte
+# chunk of a file, and a Merkle root combining them.
+#
+# chunks is a list of (offset, size, hexdigest) tuples, where hexdigest
+# is simply the digest of the chunk's bytes. root is the hexdigest at the
+# top of a binary tree built over the chunks: each leaf is the digest of
+# b'\x00' + the chunk's (binary) digest, each parent the digest of
+# b'\x01' + left child + right child, and a node without a partner is
+# carried up to the next level as-is. The different prefixes stop a leaf
+# being mistaken for a parent (as in RFC 6962), so files with different
+# chunks can't share a root. An empty file has no chunks and the digest
+# of no bytes as its root.
+class ChunkedHash(object):
+	def __init__(self, algo, chunk_size, chunks, root):
+		self.algo = algo
+		self.chunk_size = chunk_size
+		self.chunks = chunks
+		self.root = root
+
+	def __repr__(self):
+		return 'ChunkedHash(' + str(len(self.chunks)) + ' chunks, root ' + self.root + ')'
+
+	# Returns (offset, size) for each chunk of this file whose digest
+	# differs from the chunk at the same offset in other (including any
+	# chunks other doesn't have). Both must use the same algorithm and
+	# chunk size.
+	def changed_chunks(self, other):
+		if (self.algo, self.chunk_size) != (other.algo, other.chunk_size):
+			raise ValueError('can only compare ChunkedHashes with the same algorithm and chunk size')
+
+		theirs = dict((offset, digest) for offset, size, digest in other.chunks)
+		return [(offset, size) for offset, size, digest in self.chunks
+				if theirs.get(offset) != digest]
+
+def _merkle_root(digests, algo):
+	if not digests:
+		return _new_hasher(algo).digest()
+
+	leaves = []
+	for digest in digests:
+		hasher = _new_hasher(algo)
+		hasher.update(b'\x00' + digest)
+		leaves.append(hasher.digest())
+	digests = leaves
+
+	while len(digests) > 1:
+		parents = []
+		for i in range(0, len(digests) - 1, 2):
+			hasher = _new_hasher(algo)
+			hasher.update(b'\x01' + digests[i] + digests[i+1])
+			parents.append(hasher.digest())
+
+		if len(digests) % 2:
+			parents.append(digests[-1])
+		digests = parents
+
+	return digests[0]
+
+# Hashes filename in fixed-size chunks of chunk_size bytes, returning a
+# ChunkedHash holding each chunk's digest and a Merkle root over them.
+# Comparing two ChunkedHashes of a file shows which chunks have changed,
+# so only those need verifying or copying.
+#
+# The file is memory-mapped and its chunks hashed by workers threads at
+# once (hashlib releases the GIL while hashing). algo is as for
+# hash_files().
+def hash_file_chunks(filename, algo='sha256', chunk_size=4*1024*1024, workers=4):
+	with open(filename, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		offsets = range(0, size, chunk_size)
+		digests = []
+
+		# empty files can't be mapped (and have no chunks)
+		if size > 0:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+				def hash_chunk(offset):
+					hasher = _new_hasher(algo)
+					with view[offset:offset + chunk_size] as chunk:
+						hasher.update(chunk)
+					return hasher.digest()
+
+				with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+					digests = list(executor.map(hash_chunk, offsets))
+
+	chunks = [(offset, min(chunk_size, size - offset), digest.hex())
+			for offset, digest in zip(offsets, digests)]
+
+	return ChunkedHash(algo if type(algo) is str else _new_hasher(algo).name,
+			chunk_size, chunks, _merkle_root(digests, algo).hex())
+
+# Remembers the digests of files in an sqlite database, so files which
+# haven't changed since they were last hashed don't need reading again.
+#
+# Entries are keyed by the file's device and inode numbers, and are only
+# used if the file's size and modification time (in nanoseconds) still
+# match those recorded with them. Files changed without either of those
+# changing (which is rare) won't be noticed.
+#
+#   with hashes.HashCache('/var/cache/myapp/hashes.db', 'sha256') as cache:
+#       cache.hash_file('/path/to/file')    # reads the file
+#       cache.hash_file('/path/to/file')    # doesn't
+#       cache.stats()                       # {'hits': 1, 'misses': 1, 'entries': 1}
+#
+# Writes are committed every commit_every new digests and on close().
+class HashCache(object):
+	def __init__(self, db_path, algo='sha256', blocksize=None, commit_every=1000):
+		self.algo = algo
+		self.blocksize = blocksize
+		self.commit_every = commit_every
+
+		# stored with each digest, so one database can hold several algorithms
+		self._algo_name = algo if type(algo) is str else _new_hasher(algo).name
+
+		self.hits = 0
+		self.misses = 0
+		self._uncommitted = 0
+
+		self.db = sqlite3.connect(db_path)
+		self.db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+				'device INTEGER, inode INTEGER, algo TEXT, size INTEGER, '
+				'mtime_ns INTEGER, path TEXT, digest TEXT, '
+				'PRIMARY KEY (device, inode, algo))')
+		self.db.execute('CREATE INDEX IF NOT EXISTS hashes_path ON hashes (path)')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _lookup(self, path):
+		# returns (stat result, cached digest or None)
+		st = os.stat(path)
+		row = self.db.execute('SELECT size, mtime_ns, digest FROM hashes '
+				'WHERE device = ? AND inode = ? AND algo = ?',
+				(st.st_dev, st.st_ino, self._algo_name)).fetchone()
+
+		if row != None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+			self.hits += 1
+			return st, row[2]
+
+		self.misses += 1
+		return st, None
+
+	def _store(self, path, st, digest):
+		# only store the digest if the file didn't change while we were
+		# hashing it, otherwise it may not match the file's current contents
+		try:
+			after = os.stat(path)
+		except OSError:
+			return
+		if (after.st_ino, after.st_size, after.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+			return
+
+		self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+				(st.st_dev, st.st_ino, self._algo_name, st.st_size, st.st_mtime_ns,
+					os.path.abspath(path), digest))
+
+		self._uncommitted += 1
+		if self._uncommitted >= self.commit_every:
+			self.commit()
+
+	# returns the hexdigest of path, from the cache if possible
+	def hash_file(self, path):
+		st, digest = self._lookup(path)
+		if digest == None:
+			digest = hash_file(path, _new_hasher(self.algo), self.blocksize)
+			self._store(path, st, digest)
+
+		return digest
+
+	# As hash_files() (the module function), but using the cache. Digests
+	# found in the cache are yielded first; the remaining files are then
+	# hashed by workers threads. Files which can't be read are handled as
+	# for hash_files(), according to errors.
+	def hash_files(self, paths, workers=4, errors=None):
+		misses = {}
+		for path in paths:
+			try:
+				st, digest = self._lookup(path)
+			except OSError as e:
+				if errors != None:
+					errors(path, e)
+				else:
+					yield path, None
+				continue
+
+			if digest == None:
+				misses[path] = st
+			else:
+				yield path, digest
+
+		for path, digest in hash_files(misses, self.algo, workers, self.blocksize, errors):
+			if digest != None:
+				self._store(path, misses[path], digest)
+			yield path, digest
+
+	# forgets the digests of each of paths
+	def invalidate(self, paths):
+		self.db.executemany('DELETE FROM hashes WHERE path = ?',
+				((os.path.abspath(p),) for p in paths))
+
+	# forgets the digests of everything under directory
+	def invalidate_directory(self, directory):
+		prefix = os.path.join(os.path.abspath(directory), '')
+		self.db.execute('DELETE FROM hashes WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+
+	# forgets all digests
+	def invalidate_all(self):
+		self.db.execute('DELETE FROM hashes')
+
+	def stats(self):
+		entries = self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+		return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+	def commit(self):
+		self.db.commit()
+		self._uncommitted = 0
+
+	def close(self):
+		self.commit()
+		self.db.close()
+
 def md5_file(filename):
 	return hash_file(filename, hashlib.md5())
 
 def md5(s):
-	return hash_string(hashlib.md5())
+	return hash_string(s, hashlib.md5())
 
 def sha256_file(filename):
 	return hash_file(filename, hashlib.sha256())
 
 def sha256(s):
 	return hash_string(s, hashlib.sha256())
+
+def _benchmark(count=200, size=4*1024*1024):
+	# compares hashing count files of size bytes one at a time against
+	# hash_files() with various numbers of workers
+	directory = tempfile.mkdtemp()
+	paths = [os.path.join(directory, str(i)) for i in range(count)]
+	for path in paths:
+		with open(path, 'wb') as f:
+			f.write(os.urandom(size))
+
+	def report(name, elapsed):
+		print('%-28s %8.1f MB/s' % (name, count * size / elapsed / 1e6))
+
+	try:
+		start = time.perf_counter()
+		for path in paths: sha256_file(path)
+		report('sha256_file() per file', time.perf_counter() - start)
+
+		start = time.perf_counter()
+		for path in paths: hash_file(path, hashlib.sha256(), use_mmap=True)
+		report('hash_file(use_mmap=True)', time.perf_counter() - start)
+
+		for workers in (1, 2, 4, 8):
+			start = time.perf_counter()
+			for path, digest in hash_files(paths, 'sha256', workers=workers): pass
+			report('hash_files(workers=%d)' % workers, time.perf_counter() - start)
+	finally:
+		for path in paths: os.remove(path)
+		os.rmdir(directory)
+
+def _benchmark_strings(count=1000000):
+	# compares the time taken to hash count short keys in various ways
+	keys = ['key-%d' % i for i in range(count)]
+
+	def run(name, f):
+		start = time.perf_counter()
+		for digest in f(): pass
+		print('%-40s %6.3fs per million keys' % (name, (time.perf_counter() - start) * 1e6 / count))
+
+	run('md5() per key', lambda: (md5(k) for k in keys))
+	run("hash_strings(algo='md5')", lambda: hash_strings(keys, 'md5'))
+	run("hash_strings(algo='sha256')", lambda: hash_strings(keys, 'sha256'))
+	run('hash_strings() (blake2b, 8 bytes)', lambda: hash_strings(keys))
+	run('hash_strings(as_int=True)', lambda: hash_strings(keys, as_int=True))
+	run("hash_strings(algo='crc32')", lambda: hash_strings(keys, 'crc32'))
+
+if __name__ == '__main__':
+	_benchmark()
+	_benchmark_strings()
@@ -1,3 +1,5 @@
+import collections, collections.abc, concurrent.futures, inspect, itertools, random, threading, time, types
+
 class MethodInvocation(object):
     """Represents a method invocation intercepted by the Proxy."""
     def __init__(self, obj, _callable, method_name, method_args, method_kwargs):
@@ -10,14 +12,6 @@ class MethodInvocation(object):
     def invoke(self):
         return self.callable(*self.method_args, **self.method_kwargs)
 
-class ArgsCallWrapper(object):
-    def __init__(self, _type, name):
-        self._type = _type
-        self.name = name
-
-    def __call__(self, *args, **kwargs):
-        return getattr(self._type, self.name).__call__(*args, **kwargs)
-        
 class ProxyInterceptor(object):
     """Instances of this class can be added to a Proxy instance,
     and methods will then be called when attributes are read, written
@@ -47,13 +41,26 @@ class ProxyInterceptor(object):
 
     def on_call(self, obj, function, name, args, kwargs):
         """Called when a callable (such as a function), previously
-        retrieved from the Proxy, is called. invocation is an instance
-        of MethodInvocation.
+        retrieved from the Proxy, is called. function is the callable
+        as retrieved from obj (so for methods, it is already bound to
+        obj) and args and kwargs are the arguments it was called with.
 
         NOTE: the return value passed back to whatever called the method
         will be the return value of this method. If you want to run
-        the real underlying method on the proxied object, use invocation.invoke()."""
-        return invocation.invoke()
+        the real underlying method on the proxied object, use
+        function(*args, **kwargs)."""
+        return function(*args, **kwargs)
+
+    async def on_call_async(self, obj, function, name, args, kwargs):
+        """Like on_call(), but for coroutine functions (async def
+        methods). If this is overridden, calling a coroutine function
+        retrieved from the Proxy gives a coroutine running this method
+        instead of on_call(), so it can do things once the call has
+        finished; use await function(*args, **kwargs) to run the real
+        method. If it isn't, coroutine functions go through on_call()
+        like any other callable (which gets the coroutine back from
+        function(), before it has run)."""
+        return await function(*args, **kwargs)
 
     def on_set_attribute(self, obj, name, value):
         """Called when __setattribute__ is called on the Proxy."""
@@ -63,6 +70,15 @@ class ProxyInterceptor(object):
         """Called when __delattr__ is called on the Proxy."""
         pass
 
+    def after_set_attribute(self, obj, name, value):
+        """Called once the Proxy has set the attribute on obj (or tried
+        to, if setting it raised an exception)."""
+        pass
+
+    def after_del_attribute(self, obj, name):
+        """Called once the Proxy has deleted the attribute from obj (or
+        tried to, if deleting it raised an exception)."""
+        pass
 
 class DebugProxyInterceptor(ProxyInterceptor):
     """Example interceptor implementation."""
@@ -73,9 +89,9 @@ class DebugProxyInterceptor(ProxyInterceptor):
     def on_get_callable(self, obj, name):
         print(('ogc', name))
 
-    def on_call(self, invocation):
-        print(('oc', invocation.method_name, invocation.method_args, invocation.method_kwargs))
-        return invocation.invoke()
+    def on_call(self, obj, function, name, args, kwargs):
+        print(('oc', name, args, kwargs))
+        return function(*args, **kwargs)
 
     def on_set_attribute(self, obj, name, value):
         print(('osa', name, value))
@@ -83,55 +99,629 @@ class DebugProxyInterceptor(ProxyInterceptor):
     def on_del_attribute(self, obj, name):
         print(('oda', name))
 
+class _MethodProfile(object):
+    """Statistics collected by ProfilingInterceptor for one method."""
+    def __init__(self):
+        # counts calls without needing a lock (next() on a count is
+        # atomic); read it with calls()
+        self.counter = itertools.count()
+        self.peeks = 0
+        self.sampled = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.samples = []
+        self.arg_size_total = 0
+        self.arg_size_max = 0
+
+    def calls(self):
+        """Returns the number of calls so far (call with the
+        ProfilingInterceptor's lock held)."""
+        # reading the counter also advances it, so take off the reads
+        calls = next(self.counter) - self.peeks
+        self.peeks += 1
+        return calls
+
+def _arg_size(args, kwargs):
+    """Returns the total len() of all the arguments which have one."""
+    size = 0
+    for arg in itertools.chain(args, kwargs.values()):
+        if isinstance(arg, collections.abc.Sized):
+            size += len(arg)
+    return size
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class ProfilingInterceptor(ProxyInterceptor):
+    """Interceptor which profiles the method calls made through a Proxy:
+
+        profiler = ProfilingInterceptor(sample_rate=10)
+        p = Proxy(obj, profiler)
+        ...
+        profiler.snapshot()['execute']['p99']
+
+    Every call is counted, but only one in every sample_rate calls to
+    each method is timed (with time.perf_counter_ns()) and has the sizes of its
+    arguments measured, to keep the overhead down. Percentiles are
+    worked out from up to max_samples timings per method, picked at
+    random from all those taken (so they represent the whole run).
+
+    One ProfilingInterceptor can be shared by several Proxies (and
+    threads); their calls are added up together."""
+
+    def __init__(self, sample_rate=1, max_samples=1000):
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+
+        self._lock = threading.Lock()
+        self._profiles = {}
+
+    def _profile(self, name):
+        profile = self._profiles.get(name)
+        if profile is None:
+            with self._lock:
+                profile = self._profiles.get(name)
+                if profile is None:
+                    profile = self._profiles[name] = _MethodProfile()
+        return profile
+
+    def on_call(self, obj, function, name, args, kwargs):
+        if not self._sample(name):
+            return function(*args, **kwargs)
+
+        start = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self._record(name, elapsed, _arg_size(args, kwargs))
+
+    async def on_call_async(self, obj, function, name, args, kwargs):
+        # times from the call until the coroutine finishes, including any
+        # time spent waiting for other tasks
+        if not self._sample(name):
+            return await function(*args, **kwargs)
+
+        start = time.perf_counter_ns()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self._record(name, elapsed, _arg_size(args, kwargs))
+
+    def _sample(self, name):
+        """Counts the call, returning True if it should be timed."""
+        return next(self._profile(name).counter) % self.sample_rate == 0
+
+    def _record(self, name, elapsed, arg_size):
+        profile = self._profile(name)
+        with self._lock:
+            profile.sampled += 1
+            profile.total_ns += elapsed
+            profile.max_ns = max(profile.max_ns, elapsed)
+            profile.arg_size_total += arg_size
+            profile.arg_size_max = max(profile.arg_size_max, arg_size)
+
+            # reservoir sampling: keep each timing with an equal chance
+            if len(profile.samples) < self.max_samples:
+                profile.samples.append(elapsed)
+            else:
+                i = random.randrange(profile.sampled)
+                if i < self.max_samples:
+                    profile.samples[i] = elapsed
+
+    def snapshot(self):
+        """Returns a dict mapping each method name to a dict of its
+        statistics so far (times are in seconds):
+            calls: number of calls
+            sampled: number of calls timed
+            sampled_time: total time of the timed calls
+            estimated_total_time: sampled_time scaled up to all calls
+            mean, p50, p90, p99, max: call times
+            arg_size_mean, arg_size_max: total len() of the arguments
+        """
+        with self._lock:
+            result = {}
+            for name, profile in self._profiles.items():
+                calls = profile.calls()
+                stats = {'calls': calls, 'sampled': profile.sampled}
+
+                if profile.sampled:
+                    ordered = sorted(profile.samples)
+                    mean = profile.total_ns / profile.sampled / 1e9
+                    stats.update({
+                        'sampled_time': profile.total_ns / 1e9,
+                        'estimated_total_time': mean * calls,
+                        'mean': mean,
+                        'p50': _percentile(ordered, 0.5) / 1e9,
+                        'p90': _percentile(ordered, 0.9) / 1e9,
+                        'p99': _percentile(ordered, 0.99) / 1e9,
+                        'max': profile.max_ns / 1e9,
+                        'arg_size_mean': profile.arg_size_total / profile.sampled,
+                        'arg_size_max': profile.arg_size_max,
+                    })
+
+                result[name] = stats
+            return result
+
+    def reset(self):
+        """Throws away all statistics collected so far."""
+        with self._lock:
+            self._profiles = {}
+
+# marks a call which isn't cached by CachingInterceptor
+_MISSING = object()
+
+class CachingInterceptor(ProxyInterceptor):
+    """Interceptor which remembers the results of method calls made
+    through a Proxy, so that calling the same method again with the same
+    arguments returns the remembered result without calling the method:
+
+        cache = CachingInterceptor(methods=['get_user', 'list_groups'],
+                invalidate_on=['add_user'], ttl=60, max_size=1000)
+        p = Proxy(obj, cache)
+
+    methods is the names of the methods to cache; only use this for
+    methods which always return the same thing for the same arguments
+    (until the object is changed). Other methods are never cached.
+
+    Calling any method named in invalidate_on, or setting or deleting an
+    attribute through the Proxy, throws away everything cached for that
+    object, both before and after the change is made (so a call which
+    raced with the change can't leave behind a result from before it).
+
+    Results are thrown away ttl seconds after being cached (if ttl is
+    not None), and once there are more than max_size results the least
+    recently used ones are dropped.
+
+    Calls with arguments which can't be hashed (lists, dicts, etc) are
+    not cached. Exceptions raised by methods are not cached either.
+
+    One CachingInterceptor can be shared by several Proxies (and
+    threads); each proxied object has its own cached results."""
+
+    def __init__(self, methods, invalidate_on=(), ttl=None, max_size=1024):
+        self.methods = frozenset(methods)
+        self.invalidate_on = frozenset(invalidate_on)
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # key -> (expiry time, obj, result), least recently used first.
+        # obj is kept so that its id() can't be reused by another object
+        # while its results are cached
+        self._cache = collections.OrderedDict()
+        # id(obj) -> keys in _cache for that object
+        self._keys = {}
+        # incremented on every invalidation; a result is only stored if
+        # nothing was invalidated while the method was running
+        self._generation = 0
+
+    def on_call(self, obj, function, name, args, kwargs):
+        if name in self.invalidate_on:
+            self.invalidate(obj)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.invalidate(obj)
+
+        if name not in self.methods:
+            return function(*args, **kwargs)
+
+        result, key, generation = self._lookup(obj, name, args, kwargs)
+        if result is not _MISSING:
+            return result
+
+        result = function(*args, **kwargs)
+        if key is not None:
+            self._store(obj, key, generation, result)
+        return result
+
+    async def on_call_async(self, obj, function, name, args, kwargs):
+        if name in self.invalidate_on:
+            self.invalidate(obj)
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.invalidate(obj)
+
+        if name not in self.methods:
+            return await function(*args, **kwargs)
+
+        result, key, generation = self._lookup(obj, name, args, kwargs)
+        if result is not _MISSING:
+            return result
+
+        result = await function(*args, **kwargs)
+        if key is not None:
+            self._store(obj, key, generation, result)
+        return result
+
+    def _lookup(self, obj, name, args, kwargs):
+        """Returns (result, key, generation). result is _MISSING if the
+        call isn't cached, and key is None if it can't be (because the
+        arguments can't be hashed)."""
+        now = time.monotonic()
+        with self._lock:
+            try:
+                key = (id(obj), name, args,
+                        frozenset(kwargs.items()) if kwargs else None)
+                entry = self._cache.get(key)
+            except TypeError:
+                # unhashable arguments
+                self.misses += 1
+                return _MISSING, None, None
+
+            if entry is not None:
+                if entry[0] is None or entry[0] > now:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return entry[2], key, None
+                self._remove(key)
+
+            self.misses += 1
+            return _MISSING, key, self._generation
+
+    def _store(self, obj, key, generation, result):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if self._generation == generation:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                self._cache[key] = (expires, obj, result)
+                self._keys.setdefault(id(obj), set()).add(key)
+                while len(self._cache) > self.max_size:
+                    self._remove(next(iter(self._cache)))
+
+    def on_set_attribute(self, obj, name, value):
+        self.invalidate(obj)
+
+    def on_del_attribute(self, obj, name):
+        self.invalidate(obj)
+
+    def after_set_attribute(self, obj, name, value):
+        self.invalidate(obj)
+
+    def after_del_attribute(self, obj, name):
+        self.invalidate(obj)
+
+    def _remove(self, key):
+        del self._cache[key]
+        keys = self._keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys[key[0]]
+
+    def invalidate(self, obj=None):
+        """Throws away the cached results for obj, or for every object
+        if obj is None."""
+        with self._lock:
+            self._generation += 1
+            if obj is None:
+                self._cache.clear()
+                self._keys.clear()
+            else:
+                for key in self._keys.pop(id(obj), ()):
+                    del self._cache[key]
+
+    def stats(self):
+        """Returns a dict with the number of cache hits and misses so
+        far and the number of results currently cached."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._cache)}
+
+class _PendingBatch(object):
+    """Calls to one method of one object waiting to be sent as a batch."""
+    def __init__(self, obj):
+        self.obj = obj
+        self.calls = []
+        self.timer = None
+
+class BatchingInterceptor(ProxyInterceptor):
+    """Interceptor which collects calls to some of the methods of the
+    proxied object and makes them in batches, for objects where each call
+    has a fixed cost (a round trip to a database or server) which can be
+    shared between many calls:
+
+        class Users(object):
+            def get_user(self, name): ...
+            def get_users(self, calls):
+                names = [args[0] for args, kwargs in calls]
+                ...
+                return users    # one result per call, in order
+
+        batcher = BatchingInterceptor({'get_user': 'get_users'})
+        p = Proxy(Users(), batcher)
+        futures = [p.get_user(n) for n in names]
+        users = [f.result() for f in futures]
+
+    batches maps the name of each method to batch to either the name of
+    a method on the proxied object, or a function which is called as
+    function(obj, calls) (so it can also be an unbound method). Either
+    way calls is a list of (args, kwargs) tuples, one for each call being
+    batched, and it must return a list of results in the same order.
+
+    Calls to batched methods return a concurrent.futures.Future (or with
+    wait=True, block until the batch has run and return the result). A
+    batch is sent once max_batch calls are waiting (in the thread making
+    the last call), or max_delay seconds after the first call was made
+    (in a timer thread), or when flush() is called. If the batch raises
+    an exception, or returns the wrong number of results, the exception
+    is set on every Future in the batch.
+
+    Calls to other methods are passed straight through."""
+
+    def __init__(self, batches, max_batch=100, max_delay=0.01, wait=False):
+        self.batches = dict(batches)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.wait = wait
+
+        self._lock = threading.Lock()
+        # (id(obj), method name) -> _PendingBatch
+        self._pending = {}
+        self._closed = False
+
+    def on_call(self, obj, function, name, args, kwargs):
+        if name not in self.batches:
+            return function(*args, **kwargs)
+
+        future = concurrent.futures.Future()
+        key = (id(obj), name)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('cannot batch calls after close()')
+
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = _PendingBatch(obj)
+            batch.calls.append((args, kwargs, future))
+
+            if len(batch.calls) >= self.max_batch:
+                full = self._take(key)
+            else:
+                full = None
+                if batch.timer is None:
+                    batch.timer = threading.Timer(self.max_delay,
+                            self._flush_key, (key,))
+                    batch.timer.daemon = True
+                    batch.timer.start()
+
+        if full is not None:
+            self._run(name, full)
+
+        if self.wait:
+            return future.result()
+        return future
+
+    def _take(self, key):
+        """Removes and returns the pending batch for key (call with the
+        lock held)."""
+        batch = self._pending.pop(key, None)
+        if batch is not None and batch.timer is not None:
+            batch.timer.cancel()
+        return batch
+
+    def _flush_key(self, key):
+        with self._lock:
+            batch = self._take(key)
+        if batch is not None:
+            self._run(key[1], batch)
+
+    def _run(self, name, batch):
+        calls = [c for c in batch.calls if c[2].set_running_or_notify_cancel()]
+        if not calls:
+            return
+
+        target = self.batches[name]
+        try:
+            if isinstance(target, str):
+                results = getattr(batch.obj, target)([c[:2] for c in calls])
+            else:
+                results = target(batch.obj, [c[:2] for c in calls])
+            results = list(results)
+            if len(results) != len(calls):
+                raise ValueError('batch for %s returned %d results for %d calls'
+                        % (name, len(results), len(calls)))
+        except BaseException as e:
+            for c in calls:
+                c[2].set_exception(e)
+            return
+
+        for c, result in zip(calls, results):
+            c[2].set_result(result)
+
+    def flush(self):
+        """Sends all the waiting calls now, in the calling thread."""
+        with self._lock:
+            batches = [(key[1], self._take(key)) for key in list(self._pending)]
+        for name, batch in batches:
+            self._run(name, batch)
+
+    def close(self):
+        """Sends all the waiting calls; any further calls to batched
+        methods raise RuntimeError."""
+        with self._lock:
+            self._closed = True
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+_HOOKS = ('on_get_attribute', 'get_attribute', 'on_get_callable', 'on_call',
+        'on_call_async', 'on_set_attribute', 'on_del_attribute',
+        'after_set_attribute', 'after_del_attribute')
+
+# interceptor class -> the hooks it overrides (see _overridden_hooks())
+_hooks_cache = {}
+
+def _overridden_hooks(interceptor):
+    """Returns the names of the hooks which interceptor's class implements
+    differently to ProxyInterceptor. The Proxy doesn't bother calling the
+    others, as they would do nothing. (Interceptors which don't subclass
+    ProxyInterceptor only need to implement the hooks they want called.)"""
+    cls = type(interceptor)
+    try:
+        return _hooks_cache[cls]
+    except KeyError:
+        pass
+
+    hooks = frozenset(h for h in _HOOKS
+            if getattr(cls, h, None) not in (None, getattr(ProxyInterceptor, h)))
+    _hooks_cache[cls] = hooks
+    return hooks
+
+# (class, name) -> whether name is a plain method of class
+_methods_cache = {}
+
+def _is_method(cls, name):
+    """Returns True if name is a function defined on cls (or one of its
+    bases), so that getting it from an instance of cls always gives a
+    method bound to that instance."""
+    try:
+        return _methods_cache[cls, name]
+    except KeyError:
+        pass
+
+    result = False
+    for base in cls.__mro__:
+        if name in base.__dict__:
+            result = type(base.__dict__[name]) is types.FunctionType
+            break
+
+    _methods_cache[cls, name] = result
+    return result
+
+# used to read the Proxy's own attributes without going through
+# Proxy.__getattribute__()
+_get_slot = object.__getattribute__
+
+def _call_wrapper(obj, interceptor, name, function):
+    """Returns a callable which calls function via interceptor.on_call()."""
+    def call_it(*args, **kwargs):
+        return interceptor.on_call(obj, function, name, args, kwargs)
+    return call_it
+
+def _async_call_wrapper(obj, interceptor, name, function):
+    """Returns a callable which returns the coroutine from
+    interceptor.on_call_async() for function."""
+    def call_it(*args, **kwargs):
+        return interceptor.on_call_async(obj, function, name, args, kwargs)
+    return call_it
+
+def _wrap_callable(obj, interceptor, hooks, name, function):
+    """Returns the callable the Proxy should hand out for function,
+    according to which of the call hooks the interceptor overrides."""
+    if 'on_call_async' in hooks and inspect.iscoroutinefunction(function):
+        return _async_call_wrapper(obj, interceptor, name, function)
+    if 'on_call' in hooks:
+        return _call_wrapper(obj, interceptor, name, function)
+    return function
+
 class Proxy(object):
     """Construct proxies for Python objects. Based on code at
-    http://code.activestate.com/recipes/496741-object-proxying/"""
+    http://code.activestate.com/recipes/496741-object-proxying/
+
+    Methods retrieved from the Proxy are remembered, so retrieving the
+    same method again is cheap. If the interceptor doesn't override
+    on_call() (or on_call_async(), for coroutine functions), the
+    proxied object's own bound method is handed back and calls to it
+    go straight to the object. Methods are remembered
+    until the attribute is set or deleted through the Proxy; if you set
+    an attribute on the proxied object directly which hides one of its
+    methods, the Proxy won't notice."""
 
-    __slots__ = ["_obj", "__weakref__", "_interceptor"]
+    __slots__ = ["_obj", "__weakref__", "_interceptor", "_hooks", "_callables"]
 
     def __init__(self, obj, interceptor):
         # have to use object.*() methods to ensure we don't trigger our
         # own proxy-esque code below
         object.__setattr__(self, "_obj", obj)
         object.__setattr__(self, "_interceptor", interceptor)
+        object.__setattr__(self, "_hooks", _overridden_hooks(interceptor))
+
+        # name -> callable returned for that name by __getattribute__
+        object.__setattr__(self, "_callables", {})
 
     #
     # proxying (special cases)
     #
     def __getattribute__(self, name):
         # print 'Proxy.__getattribute__(%s)'%(name)
-        _obj = object.__getattribute__(self, "_obj")
-        _interceptor = object.__getattribute__(self, "_interceptor")
+        result = _get_slot(self, "_callables").get(name)
+        if result is not None:
+            return result
+
+        _obj = _get_slot(self, "_obj")
+        _hooks = _get_slot(self, "_hooks")
 
         result = getattr(_obj, name)
+        if not _hooks:
+            # nothing to intercept (so no need to remember methods either,
+            # as there's nothing to wrap them in)
+            return result
+
+        _interceptor = _get_slot(self, "_interceptor")
 
-        if hasattr(result, '__call__'):
+        if callable(result):
+            if 'on_get_callable' in _hooks:
+                _interceptor.on_get_callable(_obj, name)
 
-            def call_it(*args, **kwargs):
-                _callable = ArgsCallWrapper(type(_obj), name)
-                return _interceptor.on_call(_obj, _callable, name, args, kwargs)
-            return call_it
+            result = _wrap_callable(_obj, _interceptor, _hooks, name, result)
+
+            # keep hold of methods so we needn't do all this next time (unless
+            # on_get_callable() needs calling every time)
+            if 'on_get_callable' not in _hooks and _is_method(type(_obj), name) \
+                    and name not in getattr(_obj, '__dict__', ()):
+                _get_slot(self, "_callables")[name] = result
+
+            return result
 
         else:
-            _interceptor.on_get_attribute(_obj, name)
-            result2 = _interceptor.get_attribute(_obj, name, result)
-            return result2
+            if 'on_get_attribute' in _hooks:
+                _interceptor.on_get_attribute(_obj, name)
+            if 'get_attribute' in _hooks:
+                result = _interceptor.get_attribute(_obj, name, result)
+            return result
 
     def __delattr__(self, name):
         # print 'Proxy.__delattr__(%s)'%(name)
         _obj = object.__getattribute__(self, "_obj")
         _interceptor = object.__getattribute__(self, "_interceptor")
 
-        _interceptor.on_del_attribute(_obj, name)
-        delattr(_obj, name)
+        _hooks = object.__getattribute__(self, "_hooks")
+
+        if 'on_del_attribute' in _hooks:
+            _interceptor.on_del_attribute(_obj, name)
+        object.__getattribute__(self, "_callables").pop(name, None)
+        try:
+            delattr(_obj, name)
+        finally:
+            if 'after_del_attribute' in _hooks:
+                _interceptor.after_del_attribute(_obj, name)
 
     def __setattr__(self, name, value):
         # print 'Proxy.__setattr__(%s, %s)'%(name, value)
         _obj = object.__getattribute__(self, "_obj")
         _interceptor = object.__getattribute__(self, "_interceptor")
 
-        _interceptor.on_set_attribute(_obj, name, value)
-        setattr(_obj, name, value)
+        _hooks = object.__getattribute__(self, "_hooks")
+
+        if 'on_set_attribute' in _hooks:
+            _interceptor.on_set_attribute(_obj, name, value)
+        object.__getattribute__(self, "_callables").pop(name, None)
+        try:
+            setattr(_obj, name, value)
+        finally:
+            if 'after_set_attribute' in _hooks:
+                _interceptor.after_set_attribute(_obj, name, value)
 
     def __bool__(self):
         _obj = object.__getattribute__(self, "_obj")
@@ -167,18 +757,35 @@ class Proxy(object):
 
     @classmethod
     def _create_class_proxy(cls, theclass):
-        """creates a proxy for the given class"""
+        """creates a proxy for the given class. This is done once per
+        class (see __new__).
+
+        Python looks special methods (__len__, __iter__ and so on) up on
+        the class rather than going through __getattribute__, so the proxy
+        class gets one for each special method theclass has. These pass
+        calls to the proxied object via the interceptor's on_call(), as
+        for any other method, so an interceptor overriding on_call() can
+        trace them (see DebugProxyInterceptor)."""
 
         def make_method(name):
             def method(self, *args, **kw):
-                print(('Proxy.[class_proxy].method(%s)'%(name)))
-                _obj = object.__getattribute__(self, "_obj")
-                return getattr(_obj, name)(*args, **kw)
+                _obj = _get_slot(self, "_obj")
+                function = getattr(_obj, name)
+
+                _hooks = _get_slot(self, "_hooks")
+                if 'on_call_async' in _hooks and inspect.iscoroutinefunction(function):
+                    return _get_slot(self, "_interceptor").on_call_async(_obj, function, name, args, kw)
+                if 'on_call' in _hooks:
+                    return _get_slot(self, "_interceptor").on_call(_obj, function, name, args, kw)
+                return function(*args, **kw)
+
+            method.__name__ = name
             return method
 
         namespace = {}
         for name in cls._special_names:
-            if hasattr(theclass, name):
+            # (e.g. unhashable classes have __hash__ = None)
+            if getattr(theclass, name, None) is not None:
                 namespace[name] = make_method(name)
         return type("%s(%s)" % (cls.__name__, theclass.__name__), (cls,), namespace)
 
@@ -204,6 +811,48 @@ class Proxy(object):
         theclass.__init__(ins, obj, *args, **kwargs)
         return ins
 
+def _benchmark(count=1000000):
+    """Compares calling a method and reading an attribute directly with
+    doing so through a Proxy."""
+    class Target(object):
+        def __init__(self):
+            self.value = 1
+
+        def add(self, a):
+            return a + 1
+
+    class Intercepting(ProxyInterceptor):
+        def on_call(self, obj, function, name, args, kwargs):
+            return function(*args, **kwargs)
+
+    def run(name, f):
+        start = time.perf_counter()
+        f()
+        print('%-52s %6.3f us/op' % (name, (time.perf_counter() - start) * 1e6 / count))
+
+    def calls(target):
+        for i in range(count): target.add(i)
+
+    def reads(target):
+        for i in range(count): target.value
+
+    target = Target()
+    plain = Proxy(target, ProxyInterceptor())
+    intercepting = Proxy(target, Intercepting())
+
+    run('direct method call', lambda: calls(target))
+    run('Proxy method call (no hooks overridden)', lambda: calls(plain))
+    run('Proxy method call (on_call overridden)', lambda: calls(intercepting))
+    run('Proxy method call (ProfilingInterceptor)',
+            lambda: calls(Proxy(target, ProfilingInterceptor())))
+    run('Proxy method call (ProfilingInterceptor, 1 in 100)',
+            lambda: calls(Proxy(target, ProfilingInterceptor(sample_rate=100))))
+    run('direct attribute read', lambda: reads(target))
+    run('Proxy attribute read', lambda: reads(plain))
+
+if __name__ == '__main__':
+    _benchmark()
+
 #
 # ------ example ------
 # >>> p = Proxy(6)
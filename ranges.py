@@ -1,12 +1,13 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
-print('ranges.py: TODO write unit tests')
+from array import array
+from bisect import bisect_left, bisect_right
+import functools, random, time, os, sys, struct, mmap, tempfile, threading
 
 # Represents a range of integers (i.e. a start and an end)
+@functools.total_ordering
 class Range(object):
-	start = 0
-	end = 0
-	size = 0
+	__slots__ = ('start', 'end')
 
 	def __init__(self, start, end):
 		if start >= end:
@@ -15,21 +16,31 @@ class Range(object):
 		self.start = start
 		self.end = end
 
-		self.size = end - start
+	@property
+	def size(self):
+		return self.end - self.start
 
 	def __repr__(self):
 		return 'Range ' + str(self.start )+ '..' + str(self.end)
 
-	def __cmp__(self, other):
+	# Ranges order by start, then end. A Range compares with a number
+	# by its start.
+	def _key(self, other):
 		if type(other) == Range:
-			if self.start == other.start:
-				return cmp(self.end, other.end)
-			return cmp(self.start, other.start)
+			return (self.start, self.end), (other.start, other.end)
 
-		else:
-			if self.start == other:
-				return cmp(self.end, other)
-			return cmp(self.start, other)
+		return self.start, other
+
+	def __eq__(self, other):
+		a, b = self._key(other)
+		return a == b
+
+	def __lt__(self, other):
+		a, b = self._key(other)
+		return a < b
+
+	def __hash__(self):
+		return hash((self.start, self.end))
 
 	def contains(self, i):
 		if type(i) == Range:
@@ -72,49 +83,222 @@ class Range(object):
 #   # ranges = (0,16)
 #   # (1,3) is already included in our range so it is effectively ignored
 #
+# Internally the ranges are kept as two sorted arrays of start and end
+# points (64-bit ints, so 16 bytes per range), and finding where a range
+# goes (or whether a number is covered) is a binary search. Range objects
+# are only created when they're asked for, via the ranges property or by
+# iterating over the Ranges.
+#
 class Ranges(object):
 	def __init__(self):
-		self.ranges = []
-
-		# start and end of the entire range (ie the start point of the 
-		# starting range to the end point of the finishing range)
-		self.start = 0
-		self.end = 0
+		# _starts[i].._ends[i] is the i'th range. Both arrays are sorted, and
+		# no two ranges overlap or touch (they would have been merged).
+		self._starts = array('q')
+		self._ends = array('q')
 
 	def __repr__(self):
 		return str(self.ranges)
 
-	def _cleanup(self):
-		old_ranges = list(self.ranges)
-		old_ranges.sort()
+	def __len__(self):
+		return len(self._starts)
+
+	def __iter__(self):
+		for start, end in zip(self._starts, self._ends):
+			yield Range(start, end)
+
+	@property
+	def ranges(self):
+		return list(self)
+
+	# start and end of the entire range (ie the start point of the 
+	# starting range to the end point of the finishing range)
+	@property
+	def start(self):
+		return self._starts[0] if self._starts else 0
 
-		i = 0
-		while i < (len(old_ranges)-1):
-			# get the next item, compare it with the item that follows it
-			item = old_ranges[i]
-			next_item = old_ranges[i+1]
+	@property
+	def end(self):
+		return self._ends[-1] if self._ends else 0
 
-			if item.end >= next_item.start:
-				old_ranges.pop(i)
-				old_ranges.pop(i) # effectively this removes item at i+1
+	def add_range(self, range):
+		starts = self._starts
+		ends = self._ends
+
+		# ranges lo..hi-1 overlap or touch the new range: lo is the first
+		# range ending at or after range.start, hi the first starting
+		# after range.end
+		lo = bisect_left(ends, range.start)
+		hi = bisect_right(starts, range.end, lo)
+
+		if type(starts) is not array:
+			# loaded read-only via mmap; take a copy we can change
+			self._starts = starts = array('q', starts)
+			self._ends = ends = array('q', ends)
 
-				new_range = Range(item.start, max(item.end, next_item.end))
-				old_ranges.append(new_range)
-				old_ranges.sort()
+		if lo == hi:
+			starts.insert(lo, range.start)
+			ends.insert(lo, range.end)
 
+		else:
+			starts[lo:hi] = array('q', (min(range.start, starts[lo]),))
+			ends[lo:hi] = array('q', (max(range.end, ends[hi-1]),))
+
+	# Adds many ranges at once. Cheaper than calling add_range() for each
+	# when adding a lot of ranges, as everything is sorted and merged in
+	# one go.
+	def add_ranges(self, ranges):
+		pairs = [(r.start, r.end) for r in ranges]
+		pairs.extend(zip(self._starts, self._ends))
+		pairs.sort()
+
+		self._replace(*_merge_pairs(pairs))
+
+	# Replaces this object's ranges with the given start and end arrays,
+	# which must already be sorted and merged
+	def _replace(self, starts, ends):
+		self._starts = starts
+		self._ends = ends
+
+	# returns a new Ranges holding the same ranges
+	def copy(self):
+		if type(self._starts) is array:
+			return Ranges._from_arrays(self._starts[:], self._ends[:])
+
+		return Ranges._from_arrays(array('q', self._starts), array('q', self._ends))
+
+	# Saves these ranges to path in a compact binary form which load() can
+	# read back. The file is written to a temporary file which then
+	# replaces path, so path always holds either the old or new ranges;
+	# both the file and the rename are fsync()ed before save() returns.
+	#
+	# The format is an 8-byte magic string, the number of ranges (n, as
+	# a little-endian unsigned 64-bit int), then n little-endian signed
+	# 64-bit start points followed by n end points.
+	def save(self, path):
+		starts = self._starts
+		ends = self._ends
+		if sys.byteorder != 'little':
+			starts = array('q', starts)
+			starts.byteswap()
+			ends = array('q', ends)
+			ends.byteswap()
+
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(struct.pack(_HEADER, _MAGIC, len(starts)))
+				f.write(starts)
+				f.write(ends)
+				f.flush()
+				os.fsync(f.fileno())
+
+			os.replace(tmp, path)
+		except BaseException:
+			os.remove(tmp)
+			raise
+
+		# make sure the rename itself is on disk too (so that a crash can't
+		# bring back the old file after, say, a PersistentRanges log has
+		# been emptied)
+		dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+		try:
+			os.fsync(dir_fd)
+		finally:
+			os.close(dir_fd)
+
+	# Loads ranges written by save(). If use_mmap is True the file is
+	# mapped into memory rather than read, so loading takes the same
+	# time however many ranges there are; the file's pages are only
+	# read as lookups touch them. The returned Ranges can still be
+	# changed, but the first change takes an in-memory copy.
+	@staticmethod
+	def load(path, use_mmap = False):
+		with open(path, 'rb') as f:
+			if use_mmap and sys.byteorder == 'little':
+				data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 			else:
-				# only move to the next item of the list if we didn't modify
-				# the current item
-				i += 1
+				data = memoryview(f.read())
 
-		self.ranges = old_ranges
+		count = _read_header(data, path)
+		starts = data[_HEADER_SIZE:_HEADER_SIZE + count * 8]
+		ends = data[_HEADER_SIZE + count * 8:]
 
-		self.start = self.ranges[0].start
-		self.end = self.ranges[-1].end
+		if not use_mmap or sys.byteorder != 'little':
+			starts = array('q', starts.tobytes())
+			ends = array('q', ends.tobytes())
+			if sys.byteorder != 'little':
+				starts.byteswap()
+				ends.byteswap()
 
-	def add_range(self, range):
-		self.ranges.append(range)
-		self._cleanup()
+		else:
+			starts = starts.cast('q')
+			ends = ends.cast('q')
+
+		return Ranges._from_arrays(starts, ends)
+
+	@staticmethod
+	def _from_arrays(starts, ends):
+		r = Ranges()
+		r._starts = starts
+		r._ends = ends
+		return r
+
+	# Set operations. These return a new Ranges and leave this one and
+	# other unchanged. Each one walks through both sets of ranges once,
+	# so takes time proportional to the number of ranges in both.
+	#
+	# For example, with a = (0,10) (20,30) and b = (5,25):
+	#   a.union(b)            # (0,30)
+	#   a.intersection(b)     # (5,10) (20,25)
+	#   a.difference(b)       # (0,5) (25,30)
+	#   b.difference(a)       # (10,20)
+	#   a.complement(Range(0, 40))   # (10,20) (30,40)
+	#
+	# a | b, a & b and a - b do the same as the first three.
+	def union(self, other):
+		return Ranges._from_arrays(*_union(self, other))
+
+	def intersection(self, other):
+		return Ranges._from_arrays(*_intersection(self, other))
+
+	def difference(self, other):
+		return Ranges._from_arrays(*_difference(self, other))
+
+	# the parts of within which aren't covered by this Ranges
+	def complement(self, within):
+		return Ranges._from_arrays(*_difference(_single(within), self))
+
+	# In-place versions of the set operations, which update this Ranges
+	# (as do |=, &= and -=)
+	def update(self, other):
+		self._replace(*_union(self, other))
+
+	def intersection_update(self, other):
+		self._replace(*_intersection(self, other))
+
+	def difference_update(self, other):
+		self._replace(*_difference(self, other))
+
+	def __or__(self, other):
+		return self.union(other)
+
+	def __and__(self, other):
+		return self.intersection(other)
+
+	def __sub__(self, other):
+		return self.difference(other)
+
+	def __ior__(self, other):
+		self.update(other)
+		return self
+
+	def __iand__(self, other):
+		self.intersection_update(other)
+		return self
+
+	def __isub__(self, other):
+		self.difference_update(other)
+		return self
 
 	# Determines if i is contained within this list of ranges.
 	#
@@ -126,11 +310,15 @@ class Ranges(object):
 	# and end are completely 'inside' or equal to a Range in this Ranges).
 	#
 	def contains(self, i):
-		for r in self.ranges:
-			if r.contains(i):
-				return True
+		if type(i) == Range:
+			start, end = i.start, i.end
+		else:
+			start = end = i
 
-		return False
+		# the last range starting at or before start is the only one
+		# that can contain it
+		idx = bisect_right(self._starts, start) - 1
+		return idx >= 0 and end <= self._ends[idx]
 
 	# Determine which parts of range are not covered by ranges within this Ranges object.
 	#
@@ -140,88 +328,447 @@ class Ranges(object):
 	# and I call:
 	#  get_uncovered_portions(Range(2, 13))
 	#
-	# I get back a new Ranges object:
-	#  (3,4) (10,12)
+	# I get back a list of Ranges:
+	#  (3,5) (10,12)
 	#
 	def get_uncovered_portions(self, range):
+		return self._uncovered(range.start, range.end, 0)[0]
+
+	# As get_uncovered_portions(), for many ranges at once. Returns a list
+	# holding the uncovered portions of each range in requests, in the
+	# same order. Requests are looked up in order of where they start, so
+	# each binary search only has to cover the ranges after the last one.
+	def get_uncovered_portions_many(self, requests):
+		requests = list(requests)
+		results = [None] * len(requests)
+
+		request_starts = [r.start for r in requests]
+		uncovered = self._uncovered
+
+		lo = 0
+		for i in sorted(range(len(requests)), key=request_starts.__getitem__):
+			results[i], lo = uncovered(request_starts[i], requests[i].end, lo)
+
+		return results
+
+	# Returns the portions of start..end not covered by any range, and the
+	# index of the first range ending after start. lo must be at or before
+	# that index.
+	def _uncovered(self, start, end, lo):
+		starts = self._starts
+		ends = self._ends
+		count = len(starts)
 		portions = []
 
-		# if we have no ranges added then none of the given range will be covered
-		if len(self.ranges) == 0:
-			return [ range ]
-
-		# if the search range doesn't overlap any items in this range this nothing
-		# in this range will cover any of the search range
-		if range.end <= self.start or range.start >= self.end:
-			return [ range ]
-		
-		search_range = Range(range.start, range.end)
-		i = 0
-		while i < len(self.ranges):
-			item = self.ranges[i]
-			
-			if item.contains(search_range):
-				# if search_range is entirely contained, exit loop (return empty list)
-				break
-
-			elif not item.contains(search_range.start):
-				# if search_range.start doesn't fall within this item, either
-				# search_range begins before item.start, or after item.end
-
-				if search_range.start < item.start:
-
-					if search_range.end < item.start:
-						# if search_range ends before this item (ie never overlaps)
-						# then add a portion representing the entire search_range and
-						# exit the loop, since we've now gone as far as the end of the
-						# search_range
-						portions.append(Range(search_range.start, search_range.end))
-						break
-
-					else:
-						# if search_range begins before this item starts (and it overlaps
-						# with this item), add a portion to account for the space between
-						# search_range.start and item.start, move beginning of search_range
-						# to item.start, and re-run loop without moving to the next item
-
-						portions.append(Range(search_range.start, item.start))
-						search_range = Range(item.start, search_range.end)
-
-				else:
-					# if this item does not overlap search range at all, ignore this item
-					i += 1 # move to next item
+		# ranges ending at or before start don't cover any of start..end
+		first = i = bisect_right(ends, start, lo)
 
-			else:
-				# if overlaps, then move the search_range up to begin at
-				# the end of this item (since it is 'covered' up to the end of this
-				# item)
-				search_range = Range(item.end, search_range.end)
+		while i < count and starts[i] < end:
+			if starts[i] > start:
+				portions.append(Range(start, starts[i]))
+
+			start = ends[i]
+			if start >= end: break
+			i += 1
+
+		else:
+			portions.append(Range(start, end))
+
+		return portions, first
+
+
+# file format used by Ranges.save() and load()
+_MAGIC = b'jpyrng\x00\x01'
+_HEADER = '<8sQ'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+def _read_header(data, path):
+	# returns the number of ranges in a file written by Ranges.save()
+	if len(data) < _HEADER_SIZE:
+		raise ValueError('not a saved Ranges file (too short): ' + str(path))
+
+	magic, count = struct.unpack_from(_HEADER, data)
+	if magic != _MAGIC:
+		raise ValueError('not a saved Ranges file: ' + str(path))
+	if len(data) != _HEADER_SIZE + count * 16:
+		raise ValueError('saved Ranges file has the wrong size: ' + str(path))
+
+	return count
+
+# A Ranges which lives on disk, so it survives restarts.
+#
+# The ranges are stored in path (in the format written by Ranges.save())
+# and every add_range() is appended to a log file (path + '.log') as it
+# happens. On startup the file is memory-mapped and any ranges in the log
+# replayed on top of it. Once the log has compact_every entries, the
+# ranges are saved to path and the log emptied.
+#
+# Adding a range is idempotent, so a crash while adding ranges or
+# compacting leaves something that loads correctly: at worst part of the
+# log is replayed again, or a partly-written last log entry is thrown
+# away. If sync is True, the log is fsync()ed after every write, so a
+# range is on disk as soon as add_range() returns; otherwise the OS
+# decides when it gets there.
+#
+# The in-place set operations (update() etc.) compact straight away.
+# intersection_update() and difference_update() remove ranges, which
+# replaying the log would add back, so they compact (emptying the log)
+# before making the change and then save the result; a crash leaves the
+# ranges as they were either before or after the operation.
+#
+class PersistentRanges(Ranges):
+	def __init__(self, path, compact_every = 100000, sync = False):
+		Ranges.__init__(self)
+		self.path = path
+		self.log_path = path + '.log'
+		self.compact_every = compact_every
+		self.sync = sync
+
+		if os.path.exists(path):
+			loaded = Ranges.load(path, use_mmap=True)
+			self._starts = loaded._starts
+			self._ends = loaded._ends
+
+		self._log = open(self.log_path, 'ab+')
+		self._log.seek(0)
+		data = self._log.read()
+
+		# drop any half-written entry so new entries line up
+		self._log_count = len(data) // _LOG_ENTRY_SIZE
+		if len(data) % _LOG_ENTRY_SIZE:
+			self._log.truncate(self._log_count * _LOG_ENTRY_SIZE)
+
+		if self._log_count:
+			entries = struct.iter_unpack(_LOG_ENTRY, data[:self._log_count * _LOG_ENTRY_SIZE])
+			Ranges.add_ranges(self, (Range(start, end) for start, end in entries))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def add_range(self, range):
+		Ranges.add_range(self, range)
+		self._write_log([range])
+
+	def add_ranges(self, ranges):
+		ranges = list(ranges)
+		Ranges.add_ranges(self, ranges)
+		self._write_log(ranges)
+
+	def update(self, other):
+		Ranges.update(self, other)
+		self.compact()
+
+	def intersection_update(self, other):
+		self.compact()
+		Ranges.intersection_update(self, other)
+		self.save(self.path)
+
+	def difference_update(self, other):
+		self.compact()
+		Ranges.difference_update(self, other)
+		self.save(self.path)
+
+	def _write_log(self, ranges):
+		self._log.write(b''.join(struct.pack(_LOG_ENTRY, r.start, r.end) for r in ranges))
+		self._log.flush()
+		if self.sync: os.fsync(self._log.fileno())
+
+		self._log_count += len(ranges)
+		if self._log_count >= self.compact_every:
+			self.compact()
+
+	# saves all ranges to path and empties the log
+	def compact(self):
+		self.save(self.path)
+
+		self._log.truncate(0)
+		self._log.flush()
+		os.fsync(self._log.fileno())
+		self._log_count = 0
+
+	def close(self):
+		self._log.close()
+
+# A Ranges which can safely be shared between threads.
+#
+# Readers never wait for writers: the ranges are held in Ranges which
+# are never changed once other threads can see them. A write makes a
+# changed copy and then swaps it in, so lookups see the ranges as they
+# were either before or after a write, never half-way through one.
+# Writes are serialised by a lock.
+#
+# Copying every range on every write would make add_range() cost time
+# proportional to the number of ranges (copying 16MB for a million of
+# them), so new ranges go into a small Ranges of recent writes which is
+# looked up alongside the main one. Only the recent ranges are copied on
+# a write; once there are merge_every of them they are merged into a new
+# main Ranges, in one pass over it. With the defaults and a million
+# ranges, add_range() manages several thousand writes a second rather
+# than a few dozen (see stress_concurrent()).
+#
+class ConcurrentRanges(object):
+	def __init__(self, ranges = None, merge_every = 1024):
+		self.merge_every = merge_every
 
-				# get the next item (because of _cleanup, we know that there will be
-				# space between item and next_item)
-				next_item = None
-				if i < len(self.ranges)-1:
-					next_item = self.ranges[i+1]
+		# (main ranges, recent ranges); replaced as a whole so readers
+		# always see a matching pair
+		self._state = (ranges.copy() if ranges != None else Ranges(), Ranges())
+		self._lock = threading.Lock()
 
-				if next_item == None or search_range.end <= next_item.start:
-					# if our search_range finishes before we get to the next item, then add a
-					# portion for search_range, and exit (since we've finished)
+		# (state, the Ranges snapshot() built by merging it)
+		self._merged = (None, None)
 
-					portions.append(Range(search_range.start, search_range.end))
-					break
+	def __repr__(self):
+		return str(list(self))
+
+	# len() and iterating work through the two Ranges as they are, rather
+	# than merging them (as snapshot() does)
+	def __len__(self):
+		ranges, recent = self._state
+		if not recent:
+			return len(ranges)
+		return _merged_len(ranges, recent)
+
+	def __iter__(self):
+		ranges, recent = self._state
+		if not recent:
+			return iter(ranges)
+		return (Range(start, end) for start, end in _merged_pairs(ranges, recent))
+
+	# Returns the current ranges as a Ranges. It won't change if ranges
+	# are added later, so can be used for several lookups which need to
+	# agree with one another. It mustn't be changed.
+	#
+	# Unless there have been no writes since the last merge, this has to
+	# build a merged copy of all the ranges, so takes time proportional to
+	# the number of ranges. The copy is kept until the next write.
+	def snapshot(self):
+		state = self._state
+		ranges, recent = state
+		if not recent:
+			return ranges
+
+		merged_state, merged = self._merged
+		if merged_state is state:
+			return merged
+
+		merged = Ranges._from_arrays(*_merge_small(ranges, recent))
+		self._merged = (state, merged)
+		return merged
 
-				else:
-					# if our search_range strays into the next_item range, add a portion
-					# to cover the space up to the beginning of the next item, then move
-					# the beginning of search_range up to the next item and re-run loop
-					
-					portions.append(Range(search_range.start, next_item.start))
-					search_range = Range(next_item.start, search_range.end)
-					
-					i += 1 # move to next item
+	def add_range(self, range):
+		with self._lock:
+			ranges, recent = self._state
+			recent = recent.copy()
+			recent.add_range(range)
+			self._swap_in(ranges, recent)
+
+	def add_ranges(self, ranges):
+		with self._lock:
+			main, recent = self._state
+			recent = recent.copy()
+			recent.add_ranges(ranges)
+			self._swap_in(main, recent)
+
+	def _swap_in(self, ranges, recent):
+		if len(recent) >= self.merge_every:
+			ranges = Ranges._from_arrays(*_merge_small(ranges, recent))
+			recent = Ranges()
+		self._state = (ranges, recent)
 
-		return portions
+	def contains(self, i):
+		if type(i) == Range:
+			# (i may be covered partly by each of the two Ranges)
+			return not self.get_uncovered_portions(i)
 
+		ranges, recent = self._state
+		return ranges.contains(i) or recent.contains(i)
+
+	def get_uncovered_portions(self, range):
+		ranges, recent = self._state
+		portions = ranges.get_uncovered_portions(range)
+		if not recent:
+			return portions
+		return [p for portion in portions for p in recent.get_uncovered_portions(portion)]
+
+	def get_uncovered_portions_many(self, requests):
+		ranges, recent = self._state
+		results = ranges.get_uncovered_portions_many(requests)
+		if not recent:
+			return results
+		return [[p for portion in portions for p in recent.get_uncovered_portions(portion)]
+				for portions in results]
+
+# each entry in a PersistentRanges log is a (start, end) pair
+_LOG_ENTRY = '<qq'
+_LOG_ENTRY_SIZE = struct.calcsize(_LOG_ENTRY)
+
+# Helpers for Ranges' set operations. Each returns a pair of sorted
+# start and end arrays, with touching or overlapping ranges merged.
+
+# merges a sorted list of (start, end) pairs
+def _merge_pairs(pairs):
+	starts = []
+	ends = []
+	for start, end in pairs:
+		if ends and start <= ends[-1]:
+			if end > ends[-1]: ends[-1] = end
+		else:
+			starts.append(start)
+			ends.append(end)
+
+	return array('q', starts), array('q', ends)
+
+# merges the ranges in small into those in a (much bigger) Ranges,
+# copying the runs of a's ranges between the ones small touches in one
+# go rather than one by one
+def _merge_small(a, small):
+	a_starts, a_ends = a._starts, a._ends
+	starts = array('q')
+	ends = array('q')
+
+	for done, lo, start, end in _merge_steps(a, small):
+		starts.extend(a_starts[done:lo])
+		ends.extend(a_ends[done:lo])
+		if start == None: break
+
+		# an earlier range may have been widened by one of a's far
+		# enough to reach this one
+		if ends and start <= ends[-1]:
+			if end > ends[-1]: ends[-1] = end
+		else:
+			starts.append(start)
+			ends.append(end)
+
+	return starts, ends
+
+# Walks through merging small into a without building the result. For
+# each range in small, yields (done, lo, start, end): a's ranges done..lo-1
+# come next, untouched, followed by start..end (the range from small,
+# widened to cover any of a's it touches). Finishes with (done, len(a),
+# None, None) for the rest of a's ranges.
+def _merge_steps(a, small):
+	a_starts, a_ends = a._starts, a._ends
+
+	done = 0
+	for start, end in zip(small._starts, small._ends):
+		# a's ranges lo..hi-1 overlap or touch start..end
+		lo = bisect_left(a_ends, start, done)
+		hi = bisect_right(a_starts, end, lo)
+
+		if lo < hi:
+			start = min(start, a_starts[lo])
+			end = max(end, a_ends[hi-1])
+
+		yield done, lo, start, end
+		done = hi
+
+	yield done, len(a_starts), None, None
+
+# the number of ranges _merge_small(a, small) would give
+def _merged_len(a, small):
+	a_ends = a._ends
+	count = 0
+	last_end = None
+
+	for done, lo, start, end in _merge_steps(a, small):
+		count += lo - done
+		if lo > done: last_end = a_ends[lo-1]
+		if start == None: break
+
+		if last_end != None and start <= last_end:
+			if end > last_end: last_end = end
+		else:
+			count += 1
+			last_end = end
+
+	return count
+
+# yields the (start, end) pairs _merge_small(a, small) would give
+def _merged_pairs(a, small):
+	a_starts, a_ends = a._starts, a._ends
+	pending = None
+
+	for done, lo, start, end in _merge_steps(a, small):
+		if lo > done:
+			if pending != None: yield pending
+			pending = None
+			for i in range(done, lo):
+				yield a_starts[i], a_ends[i]
+		if start == None: break
+
+		if pending != None and start <= pending[1]:
+			pending = (pending[0], max(pending[1], end))
+		else:
+			if pending != None: yield pending
+			pending = (start, end)
+
+	if pending != None: yield pending
+
+def _single(range):
+	return Ranges._from_arrays(array('q', (range.start,)), array('q', (range.end,)))
+
+def _union(a, b):
+	# both lists of pairs are already sorted, which sort() spots and
+	# takes advantage of
+	pairs = list(zip(a._starts.tolist(), a._ends.tolist()))
+	pairs.extend(zip(b._starts.tolist(), b._ends.tolist()))
+	pairs.sort()
+	return _merge_pairs(pairs)
+
+def _intersection(a, b):
+	# (lists are quicker to index than arrays)
+	a_starts, a_ends = a._starts.tolist(), a._ends.tolist()
+	b_starts, b_ends = b._starts.tolist(), b._ends.tolist()
+	a_count, b_count = len(a_starts), len(b_starts)
+	starts = []
+	ends = []
+
+	i = j = 0
+	while i < a_count and j < b_count:
+		a_end = a_ends[i]
+		b_end = b_ends[j]
+		start = a_starts[i] if a_starts[i] > b_starts[j] else b_starts[j]
+		end = a_end if a_end < b_end else b_end
+
+		if start < end:
+			starts.append(start)
+			ends.append(end)
+
+		# move past whichever range finishes first
+		if a_end < b_end: i += 1
+		else: j += 1
+
+	return array('q', starts), array('q', ends)
+
+def _difference(a, b):
+	b_starts, b_ends = b._starts.tolist(), b._ends.tolist()
+	b_count = len(b_starts)
+	starts = []
+	ends = []
+
+	j = 0
+	for start, end in zip(a._starts.tolist(), a._ends.tolist()):
+		# skip ranges in b which finish before this range starts
+		while j < b_count and b_ends[j] <= start: j += 1
+
+		# cut out each range in b overlapping start..end
+		k = j
+		while k < b_count and b_starts[k] < end:
+			if b_starts[k] > start:
+				starts.append(start)
+				ends.append(b_starts[k])
+			if b_ends[k] > start: start = b_ends[k]
+			k += 1
+
+		if start < end:
+			starts.append(start)
+			ends.append(end)
+
+	return array('q', starts), array('q', ends)
 
 #
 # triggers a 'must be smaller than end' bug (figures taken from real FUSE scenario)
@@ -233,4 +780,99 @@ def testNegative():
 	print(rr)
 	print((rr.get_uncovered_portions(Range(1966080, 1970176))))
 
-testNegative()
+# times adding and looking up ranges in a Ranges holding count ranges
+def benchmark(count = 1000000, operations = 10000):
+	rr = Ranges()
+
+	t = time.perf_counter()
+	rr.add_ranges(Range(i * 10, i * 10 + 5) for i in range(count))
+	print('add_ranges(%d ranges):        %.3fs' % (count, time.perf_counter() - t))
+
+	points = [random.randrange(count * 10) for i in range(operations)]
+
+	t = time.perf_counter()
+	for p in points:
+		rr.contains(p)
+	print('contains():                    %.0f/sec' % (operations / (time.perf_counter() - t)))
+
+	indexes = [random.randrange(count) for i in range(operations)]
+
+	t = time.perf_counter()
+	for i in indexes:
+		rr.add_range(Range(i * 10 + 6, i * 10 + 8))
+	print('add_range() (new range):       %.0f/sec' % (operations / (time.perf_counter() - t)))
+
+	t = time.perf_counter()
+	for i in indexes:
+		rr.add_range(Range(i * 10 + 4, i * 10 + 7))
+	print('add_range() (merging ranges):  %.0f/sec' % (operations / (time.perf_counter() - t)))
+
+	requests = [Range(p, p + 100) for p in points]
+
+	t = time.perf_counter()
+	for r in requests:
+		rr.get_uncovered_portions(r)
+	print('get_uncovered_portions():      %.0f/sec' % (operations / (time.perf_counter() - t)))
+
+	t = time.perf_counter()
+	rr.get_uncovered_portions_many(requests)
+	print('get_uncovered_portions_many(): %.0f/sec' % (operations / (time.perf_counter() - t)))
+
+	other = Ranges()
+	other.add_ranges(Range(i * 10 + 3, i * 10 + 8) for i in range(count))
+
+	for name in ('union', 'intersection', 'difference'):
+		t = time.perf_counter()
+		getattr(rr, name)(other)
+		print('%-30s %.3fs' % (name + '() of two ' + str(count) + ':', time.perf_counter() - t))
+
+# Runs readers threads looking up ranges in a ConcurrentRanges of count
+# ranges while writers threads add writes ranges each, then checks
+# every range written is there, including ranges covered partly by a
+# written range and partly by one that was there already.
+def stress_concurrent(count = 1000000, readers = 4, writers = 2, writes = 20000):
+	rr = ConcurrentRanges()
+	rr.add_ranges(Range(i * 10, i * 10 + 5) for i in range(count))
+
+	stop = threading.Event()
+	lookups = [0] * readers
+	added = [[] for w in range(writers)]
+
+	def read(n):
+		while not stop.is_set():
+			p = random.randrange(count * 10)
+			rr.get_uncovered_portions(Range(p, p + 50))
+			lookups[n] += 1
+
+	def write(n):
+		for w in range(writes):
+			i = random.randrange(count)
+			if w % 2:
+				rr.add_range(Range(i * 10 + 6, i * 10 + 8))
+				added[n].append(Range(i * 10 + 6, i * 10 + 8))
+			else:
+				# touches the range already at i * 10, so is only covered
+				# with both of them
+				rr.add_range(Range(i * 10 + 5, i * 10 + 8))
+				added[n].append(Range(i * 10 + 2, i * 10 + 7))
+
+	reader_threads = [threading.Thread(target=read, args=(n,)) for n in range(readers)]
+	writer_threads = [threading.Thread(target=write, args=(n,)) for n in range(writers)]
+
+	t = time.perf_counter()
+	for thread in reader_threads + writer_threads: thread.start()
+	for thread in writer_threads: thread.join()
+	elapsed = time.perf_counter() - t
+	stop.set()
+	for thread in reader_threads: thread.join()
+
+	print('%d writers: %.0f add_range()/sec' % (writers, writers * writes / elapsed))
+	print('%d readers: %.0f get_uncovered_portions()/sec' % (readers, sum(lookups) / elapsed))
+
+	for r in (r for rs in added for r in rs):
+		if not rr.contains(r): raise ValueError('lost ' + repr(r))
+
+if __name__ == '__main__':
+	testNegative()
+	benchmark()
+	stress_concurrent()
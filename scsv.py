@@ -1,39 +1,196 @@
 # simple csv - wrapper around csvreader which makes asserting headers a little easier
 
 from jpy.asrt import *
-import csv, codecs
+import csv, itertools, operator, array, io, os, locale, tempfile, time
+import collections, shutil, stat, mmap, gzip, bz2, lzma
+from concurrent import futures
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where we don't use pwrite() anyway
+    fcntl = None
+
+# array typecodes read_columns() accepts, and how to convert fields to them
+_FLOAT_TYPECODES = set('fd')
+_INT_TYPECODES = set('bBhHiIlLqQ')
+
+def _batches(iterable, size):
+    # yields lists of up to size items from iterable
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch: return
+        yield batch
+
+def _convert_rows(lines, converters):
+    # converts fields of each line in place; converters is a list
+    # of (column index, function) pairs
+    for line in lines:
+        for i, f in converters:
+            line[i] = f(line[i])
+        yield line
+
+def _open_zstd(filename, mode, **kwargs):
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('reading .zst files requires the zstandard module')
+
+    return zstandard.open(filename, mode, **kwargs)
+
+# functions used to open compressed files, by file extension
+_COMPRESSED_OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+    '.lzma': lzma.open,
+    '.zst': _open_zstd,
+}
+
+class _MmapLines(object):
+    # A file opened via mmap, which iterates over its lines as strings.
+    # Lines are read straight out of the mapped pages, so there's no
+    # separate read buffer for the file's data to be copied through.
+    def __init__(self, filename, encoding):
+        self.encoding = encoding
+        self.file = open(filename, 'rb')
+        self.map = None
+
+        # empty files can't be mapped
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __iter__(self):
+        if self.map == None: return iter(())
+
+        return map(operator.methodcaller('decode', self.encoding), iter(self.map.readline, b''))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
+    def close(self):
+        if self.map != None: self.map.close()
+        self.file.close()
+
+# how much of a file _record_boundaries() reads at a time
+_SCAN_BLOCK_SIZE = 1024*1024
+
+def _record_boundaries(filename, chunk_size, quotechar = '"', quoted_newlines = True):
+    # Splits a file into byte ranges of roughly chunk_size bytes which
+    # begin and end on record boundaries. Returns a list of offsets: the
+    # first is the end of the first record (the headers), the last is
+    # the size of the file, and each pair of neighbouring offsets is a
+    # range of whole records.
+    #
+    # A newline only ends a record if it isn't inside a quoted field.
+    # With quoted_newlines, we work that out by tracking whether an odd
+    # number of quotechars has been seen so far (doubled quotes inside
+    # a quoted field cancel each other out), which means reading through
+    # the whole file. Without it, newlines are assumed never to be quoted
+    # and we only read around each chunk boundary.
+    boundaries = []
+
+    with open(filename, 'rb') as f:
+        if not quoted_newlines:
+            f.readline()
+            while True:
+                offset = f.tell()
+                boundaries.append(offset)
+
+                f.seek(offset + chunk_size)
+                if not f.readline(): break
+
+            boundaries.append(os.fstat(f.fileno()).st_size)
+            return sorted(set(boundaries))
+
+        quote = quotechar.encode('ascii')
+        in_quotes = False
+        target = 0
+        offset = 0
+
+        while True:
+            block = f.read(_SCAN_BLOCK_SIZE)
+            if not block: break
+
+            pos = 0
+            while offset + len(block) > target:
+                start = max(pos, target - offset)
+                newline = block.find(b'\n', start)
+                if newline < 0: break
+
+                if block.count(quote, pos, newline) & 1: in_quotes = not in_quotes
+                pos = newline + 1
+
+                if not in_quotes:
+                    boundaries.append(offset + pos)
+                    target = offset + pos + chunk_size
+
+            if block.count(quote, pos) & 1: in_quotes = not in_quotes
+            offset += len(block)
+
+    if not boundaries or boundaries[-1] != offset:
+        boundaries.append(offset)
+
+    return boundaries
+
+def _parse_chunk(filename, start, end, encoding, delimiter, converters):
+    # parses the records between byte offsets start and end of filename;
+    # run in a worker process by CSV.get_rows_parallel()
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    reader = csv.reader(io.StringIO(data.decode(encoding), newline=''), delimiter=delimiter)
+    if converters:
+        reader = _convert_rows(reader, converters)
+
+    return list(reader)
+
+# Files ending in .gz, .bz2, .xz, .lzma or .zst are decompressed as they
+# are read (.zst needs the zstandard module). If use_mmap is True, other
+# files are read through mmap.
 class CSV(object):
-    def __init__(self, filename, delimiter=',', file_codec = None):
+    def __init__(self, filename, delimiter=',', file_codec = None, use_mmap = False):
         self.filename = filename
         self.delimiter = delimiter
         self.file_codec = file_codec
+        self.use_mmap = use_mmap
 
         self.reader = None
         self.headers = None
+        self.f = None
 
         self.generator = self.__get_next_line__()
         self.dict_generator = self.__get_next_line_as_dict__()
 
     def _open(self):
-        if self.file_codec != None:
-            return open(self.filename, 'r')
-        else:
-            return codecs.open(self.filename, 'r', self.file_codec)
+        opener = self._compressed_opener()
+        if opener != None:
+            return opener(self.filename, 'rt', encoding=self.file_codec, newline='')
+
+        if self.use_mmap:
+            return _MmapLines(self.filename, self.file_codec or locale.getpreferredencoding(False))
+
+        return open(self.filename, 'r', encoding=self.file_codec, newline='')
+
+    def _compressed_opener(self):
+        return _COMPRESSED_OPENERS.get(os.path.splitext(self.filename)[1].lower())
 
     def __get_next_line_as_dict__(self):
         # load these first
         headers = self.get_headers()
+        count = len(headers)
 
         for line in self.get_next_line():
-            asrt_eq(len(line), len(headers))
-            
-            d = {}
-
-            for i in range(0, len(headers)):
-                d[headers[i]] = line[i]
+            if len(line) != count: asrt_eq(len(line), count)
 
-            yield d
+            yield dict(zip(headers, line))
 
     def __get_next_line__(self):
         with self._open() as self.f:
@@ -59,6 +216,169 @@ class CSV(object):
     def get_next_line(self):
         return self.generator
 
+    def get_rows(self, converters = None, batch_size = None):
+        """Returns a generator over the remaining rows (after the headers),
+        each row being the list of fields as parsed by the csv module. This
+        is cheaper than get_next_line_as_dict() as no dict is built per row.
+
+        converters: if not None, either a dict mapping column names (or
+            indexes) to a function, or a list of functions (or None) in
+            the same order as the headers. Each function is called with a
+            field's string value and its return value replaces the field.
+            Columns without a converter are left as strings.
+        batch_size: if not None, yield lists of up to batch_size rows
+            instead of individual rows.
+        """
+        # read the headers first so they aren't returned as a row
+        self.get_headers()
+        rows = self.get_next_line()
+
+        if converters:
+            rows = _convert_rows(rows, self._resolve_converters(converters))
+
+        if batch_size:
+            return _batches(rows, batch_size)
+
+        return rows
+
+    def read_columns(self, dtypes = None, chunk_rows = 65536, as_numpy = False):
+        """Returns a generator of dicts, one per chunk of up to chunk_rows
+        rows, mapping column names to that chunk's values for the column.
+
+        dtypes: a dict mapping column names to an array module typecode
+            (e.g. 'q' for 64-bit ints, 'd' for doubles), or to str for
+            columns that should be kept as lists of strings. Only the
+            columns named in dtypes are returned. If None, every column
+            is returned as a list of strings.
+        chunk_rows: the number of rows per chunk
+        as_numpy: if True, numeric columns are returned as NumPy arrays
+            (sharing memory with the array.array they were read into)
+            rather than as array.arrays. Requires numpy.
+
+        Numeric fields are converted straight into the column's array,
+        so no list of strings is built for numeric columns.
+        """
+        headers = self.get_headers()
+        if dtypes == None: dtypes = dict((h, str) for h in headers)
+
+        columns = []
+        for name, dtype in dtypes.items():
+            asrt(name in headers, 'no such column: ' + str(name))
+
+            if dtype is str: convert = None
+            elif dtype in _FLOAT_TYPECODES: convert = float
+            elif dtype in _INT_TYPECODES: convert = int
+            else: raise ValueError('unsupported dtype for column ' + str(name) + ': ' + str(dtype))
+
+            columns.append((name, dtype, convert, operator.itemgetter(headers.index(name))))
+
+        if as_numpy:
+            import numpy
+
+        for rows in _batches(self.get_next_line(), chunk_rows):
+            chunk = {}
+
+            for name, dtype, convert, getter in columns:
+                if convert == None:
+                    chunk[name] = list(map(getter, rows))
+                    continue
+
+                values = array.array(dtype, map(convert, map(getter, rows)))
+                if as_numpy: values = numpy.frombuffer(values, dtype=dtype)
+                chunk[name] = values
+
+            yield chunk
+
+    def get_rows_parallel(self, workers = None, chunk_size = 64*1024*1024,
+            ordered = True, converters = None, batched = False, quoted_newlines = True):
+        """Like get_rows(), but splits the file into chunks of roughly
+        chunk_size bytes and parses them in a pool of worker processes.
+
+        workers: number of worker processes (default: one per CPU)
+        ordered: if True, rows come back in the order they appear in the
+            file; otherwise each chunk's rows are returned as soon as that
+            chunk has been parsed
+        converters: as for get_rows(), but the functions must be picklable
+            (e.g. int, float, or module-level functions) so they can be
+            sent to the workers
+        batched: if True, yield one list of rows per chunk
+        quoted_newlines: set to False if the file never has newlines
+            inside quoted fields. Finding chunk boundaries is then much
+            cheaper, as the whole file doesn't have to be scanned for
+            quotes first.
+
+        Headers are read as usual, so get_headers() and assert_headers()
+        work as normal. The file's encoding must be ASCII-compatible
+        (e.g. UTF-8), as chunks are split on newline bytes, and it must
+        not be compressed.
+        """
+        if self._compressed_opener() != None:
+            raise ValueError('compressed files cannot be read in parallel: ' + self.filename)
+
+        self.get_headers()
+        if converters:
+            converters = self._resolve_converters(converters)
+
+        boundaries = _record_boundaries(self.filename, chunk_size,
+                quoted_newlines=quoted_newlines)
+        encoding = self.file_codec or locale.getpreferredencoding(False)
+
+        chunks = self._parse_chunks(workers or os.cpu_count() or 1,
+                zip(boundaries, boundaries[1:]), encoding, converters, ordered)
+
+        if batched:
+            return chunks
+
+        return itertools.chain.from_iterable(chunks)
+
+    def _parse_chunks(self, workers, ranges, encoding, converters, ordered):
+        # parses each (start, end) byte range in ranges in a process pool,
+        # yielding a list of rows per range. Only a couple of chunks per
+        # worker are in flight at once, to bound memory use.
+        executor = futures.ProcessPoolExecutor(max_workers=workers)
+        ranges = iter(ranges)
+
+        def submit():
+            r = next(ranges, None)
+            if r == None: return None
+
+            return executor.submit(_parse_chunk, self.filename, r[0], r[1],
+                    encoding, self.delimiter, converters)
+
+        try:
+            pending = collections.deque(f for f in (submit() for i in range(workers * 2)) if f)
+
+            while pending:
+                if ordered:
+                    done = pending.popleft()
+                else:
+                    done = next(futures.as_completed(pending))
+                    pending.remove(done)
+
+                f = submit()
+                if f: pending.append(f)
+
+                yield done.result()
+
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _resolve_converters(self, converters):
+        # returns converters as a list of (column index, function) pairs
+        headers = self.get_headers()
+
+        if type(converters) is dict:
+            items = []
+            for column, f in converters.items():
+                if type(column) is not int:
+                    asrt(column in headers, 'no such column: ' + str(column))
+                    column = headers.index(column)
+                items.append((column, f))
+            return items
+
+        asrt_eq(len(converters), len(headers), 'need one converter per column')
+        return [(i, f) for i, f in enumerate(converters) if f != None]
+
     def close(self):
         if self.f != None:
             self.f.close()
@@ -66,40 +386,74 @@ class CSV(object):
 class CSVWriter(object):
     # writes CSV data
     # dest should be a file-like object
-    def __init__(self, dest, delimiter=','):
+    #
+    # buffer_size is the number of characters write_many() and
+    # write_dicts() collect before passing them on to dest
+    def __init__(self, dest, delimiter=',', buffer_size = 1024*1024):
         self.dest = dest
+        self.delimiter = delimiter
+        self.buffer_size = buffer_size
         self.writer = csv.writer(dest, delimiter=delimiter)
 
         self.headers = None
+        self._get_fields = None
 
     def write_headers(self, headers):
         if type(headers) is not list: raise ValueError('aah not a list!')
         self.headers = headers
+
+        # used to pull the fields out of dicts, in header order
+        if len(headers) == 0:
+            self._get_fields = lambda d: ()
+        elif len(headers) == 1:
+            header = headers[0]
+            self._get_fields = lambda d: (d[header],)
+        else:
+            self._get_fields = operator.itemgetter(*headers)
+
         self.write(headers)
 
     # write a list of fields as CSV-delimited data
     def write(self, data = ['']):
-        if type(data) in [str, str]: 
-            data = [data]
+        if type(data) is list:
+            self.writer.writerow(data)
+
+        elif type(data) is str:
+            self.writer.writerow([data])
 
         elif type(data) is dict:
             self._write_dict(data)
 
-        elif type(data) is not list: 
-            raise ValueError('aah not a list!')
-
         else:
-            #data = [x.encode('utf-8') for x in data]
-            self.writer.writerow(data)
+            raise ValueError('aah not a list!')
 
     def _write_dict(self, d):
         if not self.headers: raise ValueError('writing dicts only supported if write_headers() has been called')
 
-        data = []
-        for h in self.headers:
-            data.append(d[h])
+        self.writer.writerow(self._get_fields(d))
+
+    # write many rows (each a list or tuple of fields). Rows are formatted
+    # in batches of batch_size into an in-memory buffer, which is passed on
+    # to dest whenever it grows past buffer_size characters
+    def write_many(self, rows, batch_size = 10000):
+        buf = io.StringIO()
+        writer = csv.writer(buf, delimiter=self.delimiter)
+
+        for batch in _batches(rows, batch_size):
+            writer.writerows(batch)
+
+            if buf.tell() >= self.buffer_size:
+                self.dest.write(buf.getvalue())
+                buf.seek(0)
+                buf.truncate()
 
-        self.write(data)
+        self.dest.write(buf.getvalue())
+
+    # write many dicts, as write() does for a single dict
+    def write_dicts(self, dicts, batch_size = 10000):
+        if not self.headers: raise ValueError('writing dicts only supported if write_headers() has been called')
+
+        self.write_many(map(self._get_fields, dicts), batch_size)
 
     def write_columns(self, columns):
         longest_column = 0
@@ -117,12 +471,67 @@ class CSVWriter(object):
         for line in lines:
             self.write(line)
 
+def _read_raw_headers(filename, encoding, delimiter = ',', quotechar = '"'):
+    # Reads the first record of filename without parsing the rest.
+    # Returns (headers, raw header bytes, offset of the first byte after
+    # the headers, file size, line terminator to use if the file doesn't
+    # end with one (or None if it does)).
+    quote = quotechar.encode('ascii')
+
+    with open(filename, 'rb') as f:
+        raw = b''
+        while True:
+            line = f.readline()
+            raw += line
+            # a newline inside quotes doesn't end the record
+            if not line or not raw.count(quote) & 1: break
+
+        start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+
+        terminator = None
+        if size > start:
+            f.seek(size - 1)
+            if f.read(1) != b'\n':
+                terminator = b'\r\n' if raw.endswith(b'\r\n') else b'\n'
+
+    text = io.StringIO(raw.decode(encoding), newline='')
+    headers = next(csv.reader(text, delimiter=delimiter), [])
+
+    return headers, raw, start, size, terminator
+
+def _copy_range(src_fd, dst_fd, src_offset, dst_offset, count):
+    # copies count bytes between two files at the given offsets, without
+    # using either file's position, so copies can run in parallel
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+
+    while count > 0:
+        n = None
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+            except OSError:
+                # not supported between these files (e.g. across filesystems
+                # on older kernels), so fall back to copying through memory
+                use_copy_file_range = False
+
+        if n == None:
+            n = os.pwrite(dst_fd, os.pread(src_fd, min(count, _SCAN_BLOCK_SIZE), src_offset), dst_offset)
+
+        if n == 0: raise OSError('unexpected end of file copying data')
+
+        src_offset += n
+        dst_offset += n
+        count -= n
+
 class CSVCombiner(object):
     def __init__(self, outfile):
         self.outfile = outfile
         self.headers = None
 
-    def combine(self, filename): 
+    # if workers is not None, filename is parsed in parallel by that many
+    # processes (see CSV.get_rows_parallel())
+    def combine(self, filename, workers = None):
         csvw = CSVWriter(self.outfile)
         csv = CSV(filename)
         
@@ -134,5 +543,170 @@ class CSVCombiner(object):
 
         asrt_eq(self.headers, these_headers, 'file ' + filename + ' does not have matching headers')
 
+        if workers:
+                for rows in csv.get_rows_parallel(workers=workers, batched=True):
+                        csvw.writer.writerows(rows)
+                csv.close()
+                return
+
         for parts in csv.get_next_line():
                 csvw.write(parts)
+
+    # Combines several files at once. Each file's headers are read (in
+    # parallel) and checked, then everything after the headers is copied
+    # byte-for-byte to outfile, without parsing or re-writing any rows.
+    #
+    # If outfile is a regular file (opened for writing, but not appending),
+    # the files are copied concurrently into their final positions in the
+    # output using workers threads; otherwise they're streamed in order.
+    #
+    # Rows keep their original quoting and line endings. A line terminator
+    # is added after any file which doesn't end with one.
+    def combine_files(self, filenames, workers = 4, encoding = None):
+        encoding = encoding or locale.getpreferredencoding(False)
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            shards = list(executor.map(lambda f: _read_raw_headers(f, encoding), filenames))
+
+        for filename, (headers, raw, start, size, terminator) in zip(filenames, shards):
+                if self.headers is None:
+                        self.headers = headers
+                        self._write_raw(raw if raw.endswith(b'\n') else raw + b'\n')
+
+                asrt_eq(self.headers, headers, 'file ' + filename + ' does not have matching headers')
+
+        dest = self.outfile
+        dest.flush()
+        if isinstance(dest, io.TextIOBase):
+                dest = getattr(dest, 'buffer', None)
+
+        if dest != None and self._supports_pwrite(dest):
+                self._copy_parallel(dest, filenames, shards, workers)
+        else:
+                self._copy_streaming(filenames, shards, encoding)
+
+    def _write_raw(self, data):
+        if isinstance(self.outfile, io.TextIOBase):
+                if hasattr(self.outfile, 'buffer'):
+                        self.outfile.flush()
+                        self.outfile.buffer.write(data)
+                else:
+                        self.outfile.write(data.decode(locale.getpreferredencoding(False)))
+        else:
+                self.outfile.write(data)
+
+    def _supports_pwrite(self, dest):
+        if fcntl == None: return False
+
+        try:
+                fd = dest.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+                return False
+
+        # pwrite() ignores the offset for files opened in append mode
+        return stat.S_ISREG(os.fstat(fd).st_mode) and dest.seekable() and \
+                not fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND
+
+    def _copy_parallel(self, dest, filenames, shards, workers):
+        dest.flush()
+        position = dest.tell()
+        dest_fd = dest.fileno()
+
+        def copy(filename, start, size, terminator, offset):
+                with open(filename, 'rb') as f:
+                        _copy_range(f.fileno(), dest_fd, start, offset, size - start)
+                if terminator:
+                        os.pwrite(dest_fd, terminator, offset + size - start)
+
+        jobs = []
+        for filename, (headers, raw, start, size, terminator) in zip(filenames, shards):
+                jobs.append((filename, start, size, terminator, position))
+                position += size - start + len(terminator or b'')
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for f in [executor.submit(copy, *job) for job in jobs]:
+                        f.result()
+
+        dest.seek(position)
+
+    def _copy_streaming(self, filenames, shards, encoding):
+        text = isinstance(self.outfile, io.TextIOBase) and not hasattr(self.outfile, 'buffer')
+
+        for filename, (headers, raw, start, size, terminator) in zip(filenames, shards):
+                with open(filename, 'rb') as f:
+                        f.seek(start)
+                        if text:
+                                shutil.copyfileobj(io.TextIOWrapper(f, encoding, newline=''), self.outfile)
+                        else:
+                                dest = self.outfile
+                                if isinstance(dest, io.TextIOBase): dest = dest.buffer
+                                shutil.copyfileobj(f, dest, _SCAN_BLOCK_SIZE)
+
+                if terminator:
+                        self._write_raw(terminator)
+
+
+def _benchmark(rows = 500000, columns = 10):
+    """Compare rows/sec of the various CSV reading methods."""
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(['col' + str(c) for c in range(columns)])
+            for r in range(rows):
+                w.writerow([r * columns + c for c in range(columns)])
+
+        def run(name, get_iterator, **kwargs):
+            c = CSV(filename, **kwargs)
+            start = time.perf_counter()
+            for row in get_iterator(c): pass
+            elapsed = time.perf_counter() - start
+            c.close()
+            print('%-40s %12.0f rows/sec' % (name, rows / elapsed))
+
+        converters = {'col0': int, 'col1': float}
+        run('get_next_line_as_dict()', lambda c: c.get_next_line_as_dict())
+        run('get_rows()', lambda c: c.get_rows())
+        run('get_rows() with use_mmap', lambda c: c.get_rows(), use_mmap=True)
+        run('get_rows(converters)', lambda c: c.get_rows(converters))
+        run('get_rows(converters, batch_size=1000)',
+                lambda c: itertools.chain.from_iterable(c.get_rows(converters, 1000)))
+        run('read_columns(2 numeric columns)',
+                lambda c: c.read_columns({'col0': 'q', 'col1': 'd'}))
+    finally:
+        os.remove(filename)
+
+def _benchmark_writer(rows = 500000, columns = 10):
+    """Compare rows/sec of writing rows one at a time against
+    CSVWriter.write_many() and write_dicts()."""
+    headers = ['col' + str(c) for c in range(columns)]
+    lists = [[r * columns + c for c in range(columns)] for r in range(rows)]
+    dicts = [dict(zip(headers, l)) for l in lists]
+
+    def run(name, write):
+        fd, filename = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'w', newline='') as f:
+                w = CSVWriter(f)
+                w.write_headers(headers)
+
+                start = time.perf_counter()
+                write(w)
+                f.flush()
+                elapsed = time.perf_counter() - start
+        finally:
+            os.remove(filename)
+
+        print('%-40s %12.0f rows/sec' % (name, rows / elapsed))
+
+    def write_each(w, rows):
+        for row in rows: w.write(row)
+
+    run('write() per list', lambda w: write_each(w, lists))
+    run('write() per dict', lambda w: write_each(w, dicts))
+    run('write_many()', lambda w: w.write_many(lists))
+    run('write_dicts()', lambda w: w.write_dicts(dicts))
+
+if __name__ == '__main__':
+    _benchmark()
+    _benchmark_writer()